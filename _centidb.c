@@ -36,15 +36,28 @@ typedef struct {
     PyObject *batch;
     PyObject *txn_id;
     PyObject *index_keys;
+    /* Encoded value of a lazily loaded record, or NULL. While set, NULL data
+     * or index_keys are computed from it on first access. */
+    PyObject *raw;
 } Record;
 
 static PyMemberDef RecordMembers[] = {
     {"coll", T_OBJECT, offsetof(Record, coll), 0, "collection"},
-    {"data", T_OBJECT, offsetof(Record, data), 0, "data"},
     {"key", T_OBJECT, offsetof(Record, key), 0, "key"},
     {"batch", T_OBJECT, offsetof(Record, batch), 0, "batch"},
     {"txn_id", T_OBJECT, offsetof(Record, txn_id), 0, "txn_id"},
-    {"index_keys", T_OBJECT, offsetof(Record, index_keys), 0, "index_keys"},
+    {NULL}
+};
+
+static PyObject *record_get_data(PyObject *, void *);
+static int record_set_data(PyObject *, PyObject *, void *);
+static PyObject *record_get_index_keys(PyObject *, void *);
+static int record_set_index_keys(PyObject *, PyObject *, void *);
+
+static PyGetSetDef RecordGetSet[] = {
+    {"data", record_get_data, record_set_data, "data", NULL},
+    {"index_keys", record_get_index_keys, record_set_index_keys,
+        "index_keys", NULL},
     {NULL}
 };
 
@@ -63,7 +76,8 @@ static PyTypeObject RecordType = {
     .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
     .tp_doc = "_centidb.Record",
     .tp_new = record_new,
-    .tp_members = RecordMembers
+    .tp_members = RecordMembers,
+    .tp_getset = RecordGetSet
 };
 
 
@@ -74,8 +88,16 @@ static PyObject *builder_build(PyObject *, PyObject *);
 struct IndexInfo {
     PyObject *prefix;
     PyObject *func;
+    /* Declarative spec fields tuple of (name, flags), or NULL. */
+    PyObject *fields;
+    /* If true, spec produces a single value rather than a tuple. */
+    int single;
 };
 
+/* Field flags, must match centidb.FIELD_*. */
+#define FIELD_LOWER 1
+#define FIELD_INVERTED 2
+
 typedef struct {
     PyObject_HEAD
     Py_ssize_t size;
@@ -428,6 +450,36 @@ static int c_encode_key(struct writer *wtr, PyObject *tup)
 }
 
 
+/* Encode `tups` as encode_keys() would, appending the result to `wtr`. */
+static int c_encode_keys(struct writer *wtr, PyObject *tups)
+{
+    int ret = 1;
+    PyTypeObject *type = Py_TYPE(tups);
+
+    if(type != &PyList_Type) {
+        if(type != &PyTuple_Type) {
+            ret = c_encode_value(wtr, tups);
+        } else {
+            ret = c_encode_key(wtr, tups);
+        }
+    } else {
+        for(int i = 0; ret && i < PyList_GET_SIZE(tups); i++) {
+            if(i) {
+                ret = writer_putc(wtr, KIND_SEP);
+            }
+            PyObject *elem = PyList_GET_ITEM(tups, i);
+            type = Py_TYPE(elem);
+            if(type != &PyTuple_Type) {
+                ret = c_encode_value(wtr, elem);
+            } else {
+                ret = c_encode_key(wtr, elem);
+            }
+        }
+    }
+    return ret;
+}
+
+
 static PyObject *encode_keys(PyObject *self, PyObject *args)
 {
     uint8_t *prefix = NULL;
@@ -453,41 +505,70 @@ static PyObject *encode_keys(PyObject *self, PyObject *args)
         return NULL;
     }
 
-    int ret = 1;
     if(prefix) {
         if(! writer_puts(&wtr, (char *)prefix, prefix_size)) {
             return NULL;
         }
     }
 
-    PyObject *tups = PyTuple_GET_ITEM(args, 1);
-    PyTypeObject *type = Py_TYPE(tups);
+    if(c_encode_keys(&wtr, PyTuple_GET_ITEM(args, 1))) {
+        return writer_fini(&wtr);
+    }
+    Py_CLEAR(wtr.s);
+    return NULL;
+}
 
-    if(type != &PyList_Type) {
-        if(type != &PyTuple_Type) {
-            ret = c_encode_value(&wtr, tups);
-        } else {
-            ret = c_encode_key(&wtr, tups);
-        }
-    } else {
-        for(int i = 0; ret && i < PyList_GET_SIZE(tups); i++) {
-            if(i) {
-                ret = writer_putc(&wtr, KIND_SEP);
-            }
-            PyObject *elem = PyList_GET_ITEM(tups, i);
-            type = Py_TYPE(elem);
-            if(type != &PyTuple_Type) {
-                ret = c_encode_value(&wtr, elem);
-            } else {
-                ret = c_encode_key(&wtr, elem);
-            }
-        }
+
+/* Like [encode_keys(prefix, k) for k in keys], but without crossing the
+ * Python/C boundary for each key. */
+static PyObject *encode_keys_many(PyObject *self, PyObject *args)
+{
+    PyObject *py_prefix;
+    PyObject *keys;
+
+    if(! PyArg_ParseTuple(args, "SO", &py_prefix, &keys)) {
+        return NULL;
     }
 
-    if(ret) {
-        return writer_fini(&wtr);
+    PyObject *seq = PySequence_Fast(keys,
+        "encode_keys_many() keys must be a sequence.");
+    if(! seq) {
+        return NULL;
     }
-    return NULL;
+
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(seq);
+    PyObject *out = PyList_New(len);
+    if(! out) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    char *prefix = PyString_AS_STRING(py_prefix);
+    Py_ssize_t prefix_size = PyString_GET_SIZE(py_prefix);
+    for(Py_ssize_t i = 0; i < len; i++) {
+        struct writer wtr;
+        if(! writer_init(&wtr, prefix_size + 20)) {
+            Py_DECREF(out);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        if(! (writer_puts(&wtr, prefix, prefix_size) &&
+              c_encode_keys(&wtr, PySequence_Fast_GET_ITEM(seq, i)))) {
+            Py_CLEAR(wtr.s);
+            Py_DECREF(out);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        PyObject *s = writer_fini(&wtr);
+        if(! s) {
+            Py_DECREF(out);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        PyList_SET_ITEM(out, i, s);
+    }
+    Py_DECREF(seq);
+    return out;
 }
 
 
@@ -533,6 +614,7 @@ static PyObject *builder_new(PyTypeObject *type, PyObject *args,
 
     PyObject *prefix_s = PyString_FromString("prefix");
     PyObject *func_s = PyString_FromString("func");
+    PyObject *spec_s = PyString_FromString("spec");
 
     for(int i = 0; i < PyList_GET_SIZE(indices); i++) {
         struct IndexInfo *info = &self->indices[i];
@@ -541,8 +623,26 @@ static PyObject *builder_new(PyTypeObject *type, PyObject *args,
         assert(info->prefix);
         info->func = PyObject_GetAttr(index, func_s);
         assert(info->func);
+        info->fields = NULL;
+        info->single = 0;
+
+        /* Index.spec is (fields, single), or None for a plain function. */
+        PyObject *spec = PyObject_GetAttr(index, spec_s);
+        if(! spec) {
+            PyErr_Clear();
+        } else {
+            if(PyTuple_Check(spec) && PyTuple_GET_SIZE(spec) == 2) {
+                info->fields = PyTuple_GET_ITEM(spec, 0);
+                Py_INCREF(info->fields);
+                info->single = PyObject_IsTrue(PyTuple_GET_ITEM(spec, 1));
+            }
+            Py_DECREF(spec);
+        }
     }
 
+    Py_DECREF(prefix_s);
+    Py_DECREF(func_s);
+    Py_DECREF(spec_s);
     return (PyObject *)self;
 }
 
@@ -554,11 +654,86 @@ static void builder_dealloc(PyObject *self_)
         struct IndexInfo *info = &self->indices[i];
         Py_CLEAR(info->prefix);
         Py_CLEAR(info->func);
+        Py_CLEAR(info->fields);
     }
     PyMem_Free(self->indices);
     PyObject_Del(self_);
 }
 
+/* Evaluate the declarative spec of `info` against the dict `obj`, returning
+ * a new reference to the field value, or a tuple of field values. */
+static PyObject *builder_eval_spec(struct IndexInfo *info, PyObject *obj)
+{
+    Py_ssize_t size = PyTuple_GET_SIZE(info->fields);
+    PyObject *tup = PyTuple_New(size);
+    if(! tup) {
+        return NULL;
+    }
+
+    for(Py_ssize_t i = 0; i < size; i++) {
+        PyObject *field = PyTuple_GET_ITEM(info->fields, i);
+        PyObject *name = PyTuple_GET_ITEM(field, 0);
+        long flags = PyInt_AsLong(PyTuple_GET_ITEM(field, 1));
+
+        PyObject *value = PyDict_GetItem(obj, name);
+        if(! value) {
+            PyErr_SetObject(PyExc_KeyError, name);
+            Py_DECREF(tup);
+            return NULL;
+        }
+        Py_INCREF(value);
+
+        if(flags & FIELD_LOWER) {
+            PyObject *lower = PyObject_CallMethod(value, "lower", NULL);
+            Py_DECREF(value);
+            if(! lower) {
+                Py_DECREF(tup);
+                return NULL;
+            }
+            value = lower;
+        }
+
+        if(flags & FIELD_INVERTED) {
+            if(Py_TYPE(value) != &PyString_Type) {
+                PyObject *repr = PyObject_Repr(name);
+                PyErr_Format(PyExc_TypeError,
+                    "inverted field %s must be a bytestring",
+                    repr ? PyString_AsString(repr) : "?");
+                Py_XDECREF(repr);
+                Py_DECREF(value);
+                Py_DECREF(tup);
+                return NULL;
+            }
+            Py_ssize_t len = PyString_GET_SIZE(value);
+            PyObject *inverted = PyString_FromStringAndSize(NULL, len);
+            if(! inverted) {
+                Py_DECREF(value);
+                Py_DECREF(tup);
+                return NULL;
+            }
+            const char *src = PyString_AS_STRING(value);
+            char *dst = PyString_AS_STRING(inverted);
+            for(Py_ssize_t j = 0; j < len; j++) {
+                dst[j] = src[j] ^ 0xff;
+            }
+            Py_DECREF(value);
+            value = inverted;
+        }
+        PyTuple_SET_ITEM(tup, i, value);
+    }
+
+    if(info->single) {
+        PyObject *value = PyTuple_GET_ITEM(tup, 0);
+        Py_INCREF(value);
+        Py_DECREF(tup);
+        return value;
+    }
+    return tup;
+}
+
+/* Returned by an index function to omit the record from the index. */
+static PyObject *skip_sentinel;
+
 static PyObject *builder_build(PyObject *self_, PyObject *args)
 {
     IndexKeyBuilder *self = (IndexKeyBuilder *) self_;
@@ -601,13 +776,23 @@ static PyObject *builder_build(PyObject *self_, PyObject *args)
     int count = 0;
     for(int i = 0; i < self->size; i++) {
         struct IndexInfo *info = &self->indices[i];
-        PyObject *result = PyObject_Call(info->func, func_args, NULL);
+        PyObject *obj = PyTuple_GET_ITEM(args, 1);
+        PyObject *result;
+        if(info->fields && PyDict_CheckExact(obj)) {
+            result = builder_eval_spec(info, obj);
+        } else {
+            result = PyObject_Call(info->func, func_args, NULL);
+        }
         if(! result) {
             Py_DECREF(keys);
             Py_DECREF(func_args);
             Py_DECREF(suffix);
             return NULL;
         }
+        if(result == skip_sentinel) {
+            Py_DECREF(result);
+            continue;
+        }
 
         PyTypeObject *type = Py_TYPE(result);
         if(type != &PyList_Type) {
@@ -616,8 +801,9 @@ static PyObject *builder_build(PyObject *self_, PyObject *args)
             if(count < LIST_START_SIZE) {
                 PyList_SET_ITEM(keys, count, key);
             } else {
-                if(PyList_Append(keys, key)) {
-                    Py_DECREF(key);
+                int err = PyList_Append(keys, key);
+                Py_DECREF(key);
+                if(err) {
                     Py_DECREF(result);
                     Py_DECREF(keys);
                     Py_DECREF(func_args);
@@ -633,8 +819,9 @@ static PyObject *builder_build(PyObject *self_, PyObject *args)
                 if(count < LIST_START_SIZE) {
                     PyList_SET_ITEM(keys, count, key);
                 } else {
-                    if(PyList_Append(keys, key)) {
-                        Py_DECREF(key);
+                    int err = PyList_Append(keys, key);
+                    Py_DECREF(key);
+                    if(err) {
                         Py_DECREF(result);
                         Py_DECREF(keys);
                         Py_DECREF(func_args);
@@ -645,10 +832,16 @@ static PyObject *builder_build(PyObject *self_, PyObject *args)
                 count++;
             }
         }
+        Py_DECREF(result);
     }
     Py_SIZE(keys) = count;
     Py_DECREF(func_args);
     Py_DECREF(suffix);
+    /* Sorted output allows old and new keys to be diffed in a single pass. */
+    if(PyList_Sort(keys)) {
+        Py_DECREF(keys);
+        return NULL;
+    }
     return keys;
 }
 
@@ -666,21 +859,126 @@ static PyObject *record_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     self->batch = NULL;
     self->txn_id = NULL;
     self->index_keys = NULL;
-    if(! PyArg_ParseTuple(args, "OO|OOOO",
+    self->raw = NULL;
+    if(! PyArg_ParseTuple(args, "OO|OOOOO",
             &self->coll, &self->data, &self->key, &self->batch,
-            &self->txn_id, &self->index_keys)) {
+            &self->txn_id, &self->index_keys, &self->raw)) {
+        self->coll = NULL;
+        self->data = NULL;
+        self->key = NULL;
+        self->batch = NULL;
+        self->txn_id = NULL;
+        self->index_keys = NULL;
+        self->raw = NULL;
+        Py_DECREF(self);
         return NULL;
     }
+    if(self->raw == Py_None) {
+        self->raw = NULL;
+    }
+    if(self->raw) {
+        /* Lazily loaded: data is decoded from raw on first access. */
+        self->data = NULL;
+    }
+    if(self->index_keys == Py_None) {
+        self->index_keys = NULL;
+    }
     Py_XINCREF(self->coll);
     Py_XINCREF(self->data);
     Py_XINCREF(self->key);
     Py_XINCREF(self->batch);
     Py_XINCREF(self->txn_id);
     Py_XINCREF(self->index_keys);
+    Py_XINCREF(self->raw);
     return (PyObject *) self;
 }
 
 
+/* Return a new reference to coll.encoder.unpack(raw). */
+static PyObject *record_decode(Record *self)
+{
+    PyObject *encoder = PyObject_GetAttrString(self->coll, "encoder");
+    if(! encoder) {
+        return NULL;
+    }
+    PyObject *obj = PyObject_CallMethod(encoder, "unpack", "O", self->raw);
+    Py_DECREF(encoder);
+    return obj;
+}
+
+
+static PyObject *record_get_data(PyObject *self_, void *closure)
+{
+    Record *self = (Record *)self_;
+    if(! self->data) {
+        if(! self->raw) {
+            Py_RETURN_NONE;
+        }
+        self->data = record_decode(self);
+        if(! self->data) {
+            return NULL;
+        }
+    }
+    Py_INCREF(self->data);
+    return self->data;
+}
+
+
+static int record_set_data(PyObject *self_, PyObject *value, void *closure)
+{
+    Record *self = (Record *)self_;
+    if(! value) {
+        PyErr_SetString(PyExc_TypeError, "cannot delete Record.data");
+        return -1;
+    }
+    Py_INCREF(value);
+    Py_XDECREF(self->data);
+    self->data = value;
+    return 0;
+}
+
+
+static PyObject *record_get_index_keys(PyObject *self_, void *closure)
+{
+    Record *self = (Record *)self_;
+    if(! self->index_keys) {
+        if(! (self->raw && self->key && PyObject_IsTrue(self->key))) {
+            Py_RETURN_NONE;
+        }
+        /* Decode afresh, since data may have been modified. */
+        PyObject *obj = record_decode(self);
+        if(! obj) {
+            return NULL;
+        }
+        self->index_keys = PyObject_CallMethod(self->coll, "_index_keys",
+                                               "OO", self->key, obj);
+        Py_DECREF(obj);
+        if(! self->index_keys) {
+            return NULL;
+        }
+    }
+    Py_INCREF(self->index_keys);
+    return self->index_keys;
+}
+
+
+static int record_set_index_keys(PyObject *self_, PyObject *value,
+                                 void *closure)
+{
+    Record *self = (Record *)self_;
+    if(value == Py_None) {
+        value = NULL;
+    }
+    Py_XINCREF(value);
+    Py_XDECREF(self->index_keys);
+    self->index_keys = value;
+    if(self->data) {
+        Py_CLEAR(self->raw);
+    }
+    return 0;
+}
+
+
 static void record_dealloc(PyObject *self_)
 {
     Record *self = (Record *)self_;
@@ -690,6 +988,7 @@ static void record_dealloc(PyObject *self_)
     Py_CLEAR(self->batch);
     Py_CLEAR(self->txn_id);
     Py_CLEAR(self->index_keys);
+    Py_CLEAR(self->raw);
     self->ob_type->tp_free(self_);
 }
 
@@ -734,7 +1033,9 @@ static PyObject *record_repr(PyObject *self)
         }
     }
     writer_puts(&wtr, ") ", 2);
-    PyObject *repr = PyObject_Repr(record->data);
+    PyObject *data = record_get_data(self, NULL);
+    PyObject *repr = data ? PyObject_Repr(data) : NULL;
+    Py_XDECREF(data);
     if(repr) {
         writer_puts(&wtr, PyString_AS_STRING(repr), PyString_GET_SIZE(repr));
         Py_DECREF(repr);
@@ -763,7 +1064,11 @@ static int record_compare(PyObject *self_, PyObject *other_)
         Record *other = (Record *)other_;
         ret = PyObject_Compare(self->coll, other->coll);
         if(! ret) {
-            ret = dumb_cmp(self->data, other->data);
+            PyObject *data = record_get_data(self_, NULL);
+            PyObject *other_data = record_get_data(other_, NULL);
+            ret = dumb_cmp(data, other_data);
+            Py_XDECREF(data);
+            Py_XDECREF(other_data);
         }
         if(! ret) {
             ret = dumb_cmp(self->key, other->key);
@@ -997,26 +1302,11 @@ static PyObject *py_decode_key(PyObject *self, PyObject *args)
 }
 
 
-static PyObject *decode_keys(PyObject *self, PyObject *args)
+/* Decode every key following `prefix` in `s`, returning a list of tuples. The
+ * caller must already have verified `s` starts with `prefix`. */
+static PyObject *c_decode_keys(uint8_t *s, Py_ssize_t s_len,
+                               Py_ssize_t prefix_len)
 {
-    uint8_t *prefix;
-    uint8_t *s;
-    Py_ssize_t prefix_len;
-    Py_ssize_t s_len;
-
-    if(! PyArg_ParseTuple(args, "s#s#", (char **) &prefix, &prefix_len,
-                                        (char **) &s, &s_len)) {
-        return NULL;
-    }
-    if(s_len < prefix_len) {
-        PyErr_SetString(PyExc_ValueError,
-            "decode_keys() prefix smaller than input.");
-        return NULL;
-    }
-    if(memcmp(prefix, s, prefix_len)) {
-        Py_RETURN_NONE;
-    }
-
     struct reader rdr;
     if(! reader_init(&rdr, s, s_len)) {
         return NULL;
@@ -1032,6 +1322,7 @@ static PyObject *decode_keys(PyObject *self, PyObject *args)
     while(rdr.pos < rdr.size) {
         PyObject *tup = decode_key(&rdr);
         if(! tup) {
+            Py_SIZE(tups) = lpos;
             Py_DECREF(tups);
             return NULL;
         }
@@ -1053,11 +1344,182 @@ static PyObject *decode_keys(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *decode_keys(PyObject *self, PyObject *args)
+{
+    uint8_t *prefix;
+    uint8_t *s;
+    Py_ssize_t prefix_len;
+    Py_ssize_t s_len;
+
+    if(! PyArg_ParseTuple(args, "s#s#", (char **) &prefix, &prefix_len,
+                                        (char **) &s, &s_len)) {
+        return NULL;
+    }
+    if(s_len < prefix_len) {
+        PyErr_SetString(PyExc_ValueError,
+            "decode_keys() prefix smaller than input.");
+        return NULL;
+    }
+    if(memcmp(prefix, s, prefix_len)) {
+        Py_RETURN_NONE;
+    }
+    return c_decode_keys(s, s_len, prefix_len);
+}
+
+
+/* Like [decode_keys(prefix, s) for s in strs], but without crossing the
+ * Python/C boundary for each key. Elements lacking `prefix` produce None. */
+static PyObject *decode_keys_many(PyObject *self, PyObject *args)
+{
+    uint8_t *prefix;
+    Py_ssize_t prefix_len;
+    PyObject *strs;
+
+    if(! PyArg_ParseTuple(args, "s#O", (char **) &prefix, &prefix_len,
+                                       &strs)) {
+        return NULL;
+    }
+
+    PyObject *seq = PySequence_Fast(strs,
+        "decode_keys_many() strs must be a sequence.");
+    if(! seq) {
+        return NULL;
+    }
+
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(seq);
+    PyObject *out = PyList_New(len);
+    if(! out) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    for(Py_ssize_t i = 0; i < len; i++) {
+        PyObject *elem = PySequence_Fast_GET_ITEM(seq, i);
+        uint8_t *s;
+        Py_ssize_t s_len;
+        if(Py_TYPE(elem) == &PyString_Type) {
+            s = (uint8_t *) PyString_AS_STRING(elem);
+            s_len = PyString_GET_SIZE(elem);
+        } else if(PyObject_AsReadBuffer(elem, (const void **) &s, &s_len)) {
+            Py_DECREF(out);
+            Py_DECREF(seq);
+            return NULL;
+        }
+
+        PyObject *tups;
+        if(s_len < prefix_len || memcmp(prefix, s, prefix_len)) {
+            tups = Py_None;
+            Py_INCREF(tups);
+        } else if(! (tups = c_decode_keys(s, s_len, prefix_len))) {
+            Py_DECREF(out);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        PyList_SET_ITEM(out, i, tups);
+    }
+    Py_DECREF(seq);
+    return out;
+}
+
+
+/* Advance `rdr` past a single encoded key, stopping at KIND_SEP or the end of
+ * input, without constructing any Python objects. */
+static int c_skip_key(struct reader *rdr)
+{
+    uint8_t ch;
+    uint64_t u64;
+
+    while(rdr->pos < rdr->size) {
+        switch(rdr->p[rdr->pos]) {
+        case KIND_SEP:
+            return 1;
+        case KIND_NULL:
+            rdr->pos++;
+            break;
+        case KIND_INTEGER:
+        case KIND_NEG_INTEGER:
+        case KIND_BOOL:
+            rdr->pos++;
+            if(! c_decode_int(rdr, &u64)) {
+                return 0;
+            }
+            break;
+        case KIND_BLOB:
+        case KIND_TEXT:
+        case KIND_UUID:
+            rdr->pos++;
+            do {
+                if(! reader_getc(rdr, &ch)) {
+                    PyErr_SetString(PyExc_ValueError,
+                        "unterminated string; key corrupt?");
+                    return 0;
+                }
+            } while(ch);
+            break;
+        default:
+            PyErr_Format(PyExc_ValueError, "bad kind %d; key corrupt?",
+                         rdr->p[rdr->pos]);
+            return 0;
+        }
+    }
+    return 1;
+}
+
+
+static PyObject *split_keys(PyObject *self, PyObject *args)
+{
+    uint8_t *prefix;
+    uint8_t *s;
+    Py_ssize_t prefix_len;
+    Py_ssize_t s_len;
+
+    if(! PyArg_ParseTuple(args, "s#s#", (char **) &prefix, &prefix_len,
+                                        (char **) &s, &s_len)) {
+        return NULL;
+    }
+    if(s_len < prefix_len || memcmp(prefix, s, prefix_len)) {
+        Py_RETURN_NONE;
+    }
+
+    PyObject *out = PyList_New(0);
+    if(! out) {
+        return NULL;
+    }
+
+    struct reader rdr;
+    reader_init(&rdr, s, s_len);
+    rdr.pos = prefix_len;
+    for(;;) {
+        Py_ssize_t start = rdr.pos;
+        if(! c_skip_key(&rdr)) {
+            Py_DECREF(out);
+            return NULL;
+        }
+        PyObject *key = PyString_FromStringAndSize((char *) s + start,
+                                                   rdr.pos - start);
+        if(! key || PyList_Append(out, key)) {
+            Py_XDECREF(key);
+            Py_DECREF(out);
+            return NULL;
+        }
+        Py_DECREF(key);
+        if(rdr.pos == rdr.size) {
+            break;
+        }
+        rdr.pos++; // KIND_SEP
+    }
+    return out;
+}
+
+
 static PyMethodDef CentidbMethods[] = {
     {"tuplize", tuplize, METH_O, "tuplize"},
     {"decode_key", py_decode_key, METH_VARARGS, "decode_key"},
     {"decode_keys", decode_keys, METH_VARARGS, "decode_keys"},
     {"encode_keys", encode_keys, METH_VARARGS, "encode_keys"},
+    {"decode_keys_many", decode_keys_many, METH_VARARGS, "decode_keys_many"},
+    {"encode_keys_many", encode_keys_many, METH_VARARGS, "encode_keys_many"},
+    {"split_keys", split_keys, METH_VARARGS, "split_keys"},
     {"encode_int", encode_int, METH_O, "encode_int"},
     {NULL, NULL, 0, NULL}
 };
@@ -1079,4 +1541,11 @@ init_centidb(void)
     }
     PyModule_AddObject(mod, "Record", (void *) &RecordType);
     PyModule_AddObject(mod, "IndexKeyBuilder", (void *) &IndexKeyBuilderType);
+
+    skip_sentinel = PyObject_CallObject((PyObject *) &PyBaseObject_Type, NULL);
+    if(! skip_sentinel) {
+        return;
+    }
+    Py_INCREF(skip_sentinel);
+    PyModule_AddObject(mod, "SKIP", skip_sentinel);
 }
@@ -21,10 +21,16 @@ See http://centidb.readthedocs.org/
 
 from __future__ import absolute_import
 
+import bisect
+import collections
+import heapq
 import cPickle as pickle
 import cStringIO
 import functools
+import hashlib
 import itertools
+import math
+import multiprocessing
 import operator
 import os
 import re
@@ -35,9 +41,11 @@ import uuid
 import warnings
 import zlib
 
-__all__ = '''invert Store Collection Record Index decode_keys encode_keys
-    decode_int encode_int Encoder KEY_ENCODER PICKLE_ENCODER PLAIN_PACKER
-    ZLIB_PACKER next_greater'''.split()
+__all__ = '''invert Store Collection Record Index LruCache decode_keys
+    encode_keys decode_keys_many encode_keys_many split_keys decode_int
+    encode_int Encoder ZlibDictPacker AdaptivePacker BatchScheduler Field
+    BloomFilter IndexBuilder Query KEY_ENCODER PICKLE_ENCODER SKIP
+    PLAIN_PACKER ZLIB_PACKER next_greater'''.split()
 
 KIND_NULL = chr(15)
 KIND_NEG_INTEGER = chr(20)
@@ -54,6 +62,15 @@ IndexKeyBuilder = None
 ITEMGETTER_0 = operator.itemgetter(0)
 ITEMGETTER_1 = operator.itemgetter(1)
 
+#: Returned by an index function to indicate the record should have no entry
+#: in the index.
+SKIP = object()
+
+#: Largest number of keys read ahead from an engine iterator, or assigned
+#: during :py:meth:`Collection.puts`, before they are handed to
+#: :py:func:`decode_keys_many` or :py:func:`encode_keys_many` as a unit.
+CHUNK_SIZE = 64
+
 def invert(s):
     """Invert the bits in the bytestring `s`.
 
@@ -167,6 +184,17 @@ def decode_offsets(s):
         out.append(pos)
     return out, io.tell()
 
+def _block_starts(offsets, block_size):
+    """Given the output of :py:func:`decode_offsets`, return the index of the
+    first member of each sub-block of a blocked batch. A new block begins with
+    the first member found at least `block_size` bytes after the start of the
+    current block."""
+    starts = [0]
+    for i in xrange(1, len(offsets) - 1):
+        if (offsets[i] - offsets[starts[-1]]) >= block_size:
+            starts.append(i)
+    return starts
+
 _encode_pat = re.compile(r'[\x00\x01]')
 _encode_subber = lambda m: '\x01\x01' if m.group(0) == '\x00' else '\x01\x02'
 def encode_str(s):
@@ -219,62 +247,54 @@ def _eat(pred, it, total_only=False):
         return total
     return total, true
 
-def __kcmp(fn, o):
-    return fn(o[1])
-_kcmp = functools.partial(functools.partial, __kcmp)
+def _sorted_diff(old, new):
+    """Given sorted lists `old` and `new`, return `(removed, added)`, the
+    sorted lists of elements appearing only in `old`, and only in `new`."""
+    removed = []
+    added = []
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return removed, added
+
+def _chunks(it, size=CHUNK_SIZE):
+    """Yield lists of elements from the iterable `it`. The first list contains
+    a single element, with each subsequent list doubling in length until
+    `size` is reached, so short reads (e.g. :py:meth:`Collection.get`) never
+    consume more of `it` than necessary."""
+    n = 1
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+        n = min(n * 2, size)
 
 def tuplize(o):
     return o if type(o) is tuple else (o,)
 
-def encode_keys(prefix, tups):
-    """Encode a list of tuples of primitive values to a bytestring that
-    preserves a meaningful lexicographical sort order.
-
-        `prefix`:
-            Initial prefix for the bytestring, if any.
-
-    A bytestring is returned such that elements of different types at the same
-    position within distinct sequences with otherwise identical prefixes will
-    sort in the following order.
-
-        1. ``None``
-        2. Negative integers
-        3. Positive integers
-        4. ``False``
-        5. ``True``
-        6. Bytestrings (i.e. :py:func:`str`).
-        7. Unicode strings.
-        8. ``uuid.UUID`` instances.
-        9. Sequences with another tuple following the last identical element.
-
-    If `tups` is not exactly a list, it is assumed to a be single key, and will
-    be treated as if it were wrapped in a list.
-
-    If the type of any list element is not exactly a tuple, it is assumed to be
-    a single primitive value, and will be treated as if it were a 1-tuple key.
-
-    ::
-
-        >>> encode_keys(1)      # Treated like encode_keys([(1,)])
-        >>> encode_keys((1,))   # Treated like encode_keys([(1,)])
-        >>> encode_keys([1])    # Treated like encode_keys([(1,)])
-        >>> encode_keys([(1,)]) # Treated like encode_keys([(1,)])
-    """
-    ba = bytearray()
+def _encode_keys(ba, tups):
     w = ba.append
     e = ba.extend
 
     if type(tups) is not list:
         tups = [tups]
 
-    e(prefix)
-    last = len(tups) - 1
     for i, tup in enumerate(tups):
         if i:
             w(KIND_SEP)
         tup = tuplize(tup)
-        tlast = len(tup) - 1
-        for j, arg in enumerate(tup):
+        for arg in tup:
             type_ = type(arg)
             if arg is None:
                 w(KIND_NULL)
@@ -300,31 +320,63 @@ def encode_keys(prefix, tups):
                 e(encode_str(arg.encode('utf-8')))
             else:
                 raise TypeError('unsupported type: %r' % (arg,))
-    return str(ba)
 
-def decode_keys(prefix, s, first=False):
-    """Decode a bytestring produced by :py:func:`encode_keys`, returning the
-    list of tuples the string represents.
+def encode_keys(prefix, tups):
+    """Encode a list of tuples of primitive values to a bytestring that
+    preserves a meaningful lexicographical sort order.
 
         `prefix`:
-            If specified, a string prefix of this length will be skipped before
-            decoding begins. If the passed string does not start with the given
-            prefix, None is returned and the string is not decoded.
+            Initial prefix for the bytestring, if any.
 
-        `first`:
-            Stop work after the first tuple has been decoded and return it
-            immediately. Note the return value is the tuple, not a list
-            containing the tuple.
+    A bytestring is returned such that elements of different types at the same
+    position within distinct sequences with otherwise identical prefixes will
+    sort in the following order.
+
+        1. ``None``
+        2. Negative integers
+        3. Positive integers
+        4. ``False``
+        5. ``True``
+        6. Bytestrings (i.e. :py:func:`str`).
+        7. Unicode strings.
+        8. ``uuid.UUID`` instances.
+        9. Sequences with another tuple following the last identical element.
+
+    If `tups` is not exactly a list, it is assumed to a be single key, and will
+    be treated as if it were wrapped in a list.
+
+    If the type of any list element is not exactly a tuple, it is assumed to be
+    a single primitive value, and will be treated as if it were a 1-tuple key.
+
+    ::
+
+        >>> encode_keys(1)      # Treated like encode_keys([(1,)])
+        >>> encode_keys((1,))   # Treated like encode_keys([(1,)])
+        >>> encode_keys([1])    # Treated like encode_keys([(1,)])
+        >>> encode_keys([(1,)]) # Treated like encode_keys([(1,)])
     """
-    if not s.startswith(prefix):
-        return
-    s = buffer(s, len(prefix))
+    ba = bytearray(prefix)
+    _encode_keys(ba, tups)
+    return str(ba)
 
-    io = cStringIO.StringIO(s)
-    getc = functools.partial(io.read, 1)
+def encode_keys_many(prefix, keys):
+    """Return ``[encode_keys(prefix, k) for k in keys]``. With speedups
+    enabled, the whole sequence is encoded in a single call, avoiding
+    per-key interpreter overhead when many keys must be produced at once."""
+    ba = bytearray()
+    ends = []
+    for key in keys:
+        ba.extend(prefix)
+        _encode_keys(ba, key)
+        ends.append(len(ba))
+    s = str(ba)
+    return [s[start:end] for start, end in itertools.izip([0] + ends, ends)]
+
+def _decode_keys(io, getc, end, first):
     tups = []
     tup = []
-    for c in iter(getc, ''):
+    while io.tell() < end:
+        c = getc()
         if c == KIND_NULL:
             arg = None
         elif c == KIND_INTEGER:
@@ -351,9 +403,77 @@ def decode_keys(prefix, s, first=False):
     tups.append(tuple(tup))
     return tups[0] if first else tups
 
+def decode_keys(prefix, s, first=False):
+    """Decode a bytestring produced by :py:func:`encode_keys`, returning the
+    list of tuples the string represents.
+
+        `prefix`:
+            If specified, a string prefix of this length will be skipped before
+            decoding begins. If the passed string does not start with the given
+            prefix, None is returned and the string is not decoded.
+
+        `first`:
+            Stop work after the first tuple has been decoded and return it
+            immediately. Note the return value is the tuple, not a list
+            containing the tuple.
+    """
+    if not s.startswith(prefix):
+        return
+    io = cStringIO.StringIO(s)
+    io.seek(len(prefix))
+    return _decode_keys(io, functools.partial(io.read, 1), len(s), first)
+
 def decode_key(prefix, s):
     return decode_keys(prefix, s, True)
 
+def decode_keys_many(prefix, strs):
+    """Return ``[decode_keys(prefix, s) for s in strs]``. With speedups
+    enabled, the whole sequence is decoded in a single call, otherwise a
+    single buffer is shared by every string in the sequence."""
+    strs = [str(s) for s in strs]
+    io = cStringIO.StringIO(''.join(strs))
+    getc = functools.partial(io.read, 1)
+    out = []
+    end = 0
+    for s in strs:
+        start = end
+        end += len(s)
+        if s.startswith(prefix):
+            io.seek(start + len(prefix))
+            out.append(_decode_keys(io, getc, end, False))
+        else:
+            out.append(None)
+    return out
+
+_key_pat = re.compile(
+    '(?:\x0f'                                   # KIND_NULL
+    '|[\x14\x15\x1e](?:[\x00-\xf0]|[\xf1-\xf8].|\xf9..|\xfa...|\xfb....'
+    '|\xfc.{5}|\xfd.{6}|\xfe.{7}|\xff.{8})'     # KIND_*INTEGER, KIND_BOOL
+    '|[\x28\x32\x5a][^\x00]*\x00)*', re.S)      # KIND_BLOB, TEXT, UUID
+def split_keys(prefix, s):
+    """Split a bytestring produced by :py:func:`encode_keys` into a list
+    containing the encoding of each key it contains, without decoding them.
+    The encodings exclude `prefix`, and preserve the order of their source
+    tuples, so they may be compared directly against bounds produced by
+    ``encode_keys('', ...)``. If `s` does not start with `prefix`, ``None`` is
+    returned."""
+    if not s.startswith(prefix):
+        return
+    pos = len(prefix)
+    if s.find(KIND_SEP, pos) == -1:
+        return [s[pos:]]
+    end = len(s)
+    match = _key_pat.match
+    out = []
+    while True:
+        stop = match(s, pos).end()
+        out.append(s[pos:stop])
+        if stop == end:
+            return out
+        if s[stop] != KIND_SEP:
+            raise ValueError('bad kind %r; key corrupt?' % (ord(s[stop]),))
+        pos = stop + 1
+
 class Encoder(object):
     """Instances of this class represent an encoding.
 
@@ -378,6 +498,518 @@ class Encoder(object):
     def __init__(self, name, unpack, pack):
         vars(self).update(locals())
 
+class AdaptivePacker(object):
+    """Chooses, separately for each value or batch it compresses, whichever of
+    several packers scores lowest according to a cost function. The chosen
+    packer's usual prefix is recorded in the value, so reading requires no
+    extra metadata, and only the candidates need be registered with a
+    :py:class:`Store`. May be used anywhere a packer is accepted, for example
+    ``batch(packer=AdaptivePacker())``.
+
+        `packers`:
+            Sequence of candidate :py:class:`Encoder` instances. Defaults to
+            :py:data:`PLAIN_PACKER`, :py:data:`ZLIB_PACKER`, and zlib at
+            compression levels 1 and 9. Output of the extra zlib levels is
+            read by :py:data:`ZLIB_PACKER`, so records its prefix and needs no
+            registration.
+
+        `cost`:
+            Function invoked as `cost(raw_len, packed_len, unpack_secs)` for
+            each candidate, returning a number; the lowest wins, with ties
+            going to the smallest output. By default, each second of unpacking
+            is considered as costly as storing 10MB.
+
+        `unpack_costs`:
+            Mapping of packer name to the estimated seconds spent unpacking
+            each byte of output, used for `unpack_secs` instead of timing the
+            candidate, so the same value always selects the same packer.
+            Entries for ``plain``, ``zlib`` and ``zlib:<level>`` are provided.
+            Candidates without an entry are timed, taking the median of
+            several runs.
+
+        `sample_size`:
+            If not ``None``, candidates are compared using at most this many
+            leading bytes of each value, and only the winner compresses the
+            whole value.
+
+    ::
+
+        # Prefer faster decompression unless zlib saves at least 30%.
+        packer = centidb.AdaptivePacker(
+            cost=lambda raw, packed, secs: packed * (1.3 if secs > 1e-4 else 1))
+    """
+    #: Number of times each candidate's output is unpacked to time it.
+    TIMINGS = 3
+
+    def __init__(self, packers=None, cost=None, sample_size=None,
+                 unpack_costs=None):
+        self.packers = tuple(packers or
+                             (PLAIN_PACKER, ZLIB_PACKER) + _ZLIB_LEVELS)
+        self.cost = cost or self._default_cost
+        self.sample_size = sample_size
+        self.unpack_costs = dict(_UNPACK_COSTS)
+        self.unpack_costs.update(unpack_costs or {})
+
+    @staticmethod
+    def _default_cost(raw_len, packed_len, unpack_secs):
+        return packed_len + (unpack_secs * 1e7)
+
+    def _unpack_secs(self, packer, raw_len, packed):
+        per_byte = self.unpack_costs.get(packer.name)
+        if per_byte is not None:
+            return raw_len * per_byte
+        times = []
+        for _ in xrange(self.TIMINGS):
+            t0 = time.time()
+            packer.unpack(packed)
+            times.append(time.time() - t0)
+        return sorted(times)[len(times) // 2]
+
+    def choose(self, s):
+        """Return `(packer, packed)` for the cheapest packer for `s`, where
+        `packed` is its output, or ``None`` if only a sample was compressed."""
+        sample = s
+        if self.sample_size is not None and len(s) > self.sample_size:
+            sample = s[:self.sample_size]
+        best = None
+        for packer in self.packers:
+            packed = packer.pack(sample)
+            secs = self._unpack_secs(packer, len(sample), packed)
+            score = self.cost(len(sample), len(packed), secs), len(packed)
+            if best is None or score < best[0]:
+                best = score, packer, packed
+        return best[1], (best[2] if sample is s else None)
+
+def _train_zdict(samples, size, gram=8, seg=48):
+    # Greedily pick `seg`-byte segments of the samples, scored by how many
+    # samples share each of their `gram`-byte substrings, until `size` bytes
+    # are chosen. Substrings covered by a chosen segment no longer count
+    # towards the score of others. zlib encodes nearer matches more cheaply,
+    # so the best segments are placed at the end.
+    counts = collections.defaultdict(int)
+    for s in samples:
+        for g in set(s[i:i+gram] for i in xrange(len(s) - gram + 1)):
+            counts[g] += 1
+
+    heap = []
+    for s in samples:
+        for i in xrange(0, max(1, len(s) - gram + 1), seg // 2):
+            segment = s[i:i+seg]
+            grams = set(g for g in (segment[j:j+gram]
+                        for j in xrange(len(segment) - gram + 1))
+                        if counts[g] > 1)
+            if grams:
+                score = sum(counts[g] for g in grams)
+                heap.append((-score, len(heap), segment, grams))
+    heapq.heapify(heap)
+
+    used = set()
+    out = []
+    total = 0
+    while heap and total < size:
+        score, i, segment, grams = heapq.heappop(heap)
+        grams -= used
+        new = sum(counts[g] for g in grams)
+        if new < -score:
+            if new:
+                heapq.heappush(heap, (-new, i, segment, grams))
+            continue
+        out.append(segment)
+        used |= grams
+        total += len(segment)
+    return ''.join(reversed(out))[-size:]
+
+class ZlibDictPacker(Encoder):
+    """An :py:class:`Encoder` for use as a packer, that compresses values
+    using zlib with a preset dictionary trained from sample records. Small,
+    similar records that barely compress on their own can then compress well
+    without resorting to batching.
+
+    Dictionaries are persisted in :py:class:`Store` metadata, and every packed
+    value is prefixed with the ID of the dictionary used, so values packed
+    with older dictionaries remain readable after :py:meth:`train` installs a
+    new one. Until a dictionary is trained, values are compressed without one.
+
+        `store`:
+            :py:class:`Store` the dictionaries are kept in.
+
+        `name`:
+            ASCII name of the dictionary family, usually the name of the
+            collection it is trained for. The packer is registered as
+            ``"zdict:<name>"``.
+
+        `level`:
+            zlib compression level.
+
+    ::
+
+        packer = centidb.ZlibDictPacker(store, 'people')
+        coll = centidb.Collection(store, 'people', packer=packer)
+        # ...
+        packer.train(coll.encoder.pack(v) for v in coll.values(max=1000))
+    """
+    def __init__(self, store, name, level=6):
+        self.store = store
+        self.name = 'zdict:' + name
+        self.level = level
+        self._states = {}
+        #: ID of the dictionary used to pack new values, or ``0`` if none has
+        #: been trained.
+        self.dict_id = self._last_id(None)
+
+    def _prime(self, zdict):
+        # Python 2's zlib lacks preset dictionary support, so one is emulated
+        # by compressing the dictionary into a raw deflate stream, flushing
+        # to a byte boundary, and discarding the output. Copies of the primed
+        # (de)compressor may then refer back into the dictionary.
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+        if zdict:
+            primed = comp.compress(zdict) + comp.flush(zlib.Z_SYNC_FLUSH)
+            decomp.decompress(primed)
+        return comp, decomp
+
+    def _state(self, dict_id):
+        state = self._states.get(dict_id)
+        if state is None:
+            zdict = None
+            if dict_id:
+                tup = self.store._dict_coll.get((self.name, dict_id))
+                if not tup:
+                    raise ValueError('Missing dictionary: %r / %d' %
+                                     (self.name, dict_id))
+                zdict = tup[2]
+                if dict_id > self.dict_id:
+                    # Trained by another instance; pack using the latest.
+                    self.dict_id = self._last_id(None)
+            state = self._states[dict_id] = self._prime(zdict)
+        return state
+
+    def pack(self, s):
+        comp = self._state(self.dict_id)[0].copy()
+        return encode_int(self.dict_id) + comp.compress(s) + comp.flush()
+
+    def unpack(self, s):
+        io = cStringIO.StringIO(s)
+        dict_id = decode_int(functools.partial(io.read, 1), io.read)
+        decomp = self._state(dict_id)[1].copy()
+        return decomp.decompress(buffer(s, io.tell())) + decomp.flush()
+
+    def train(self, samples, size=16384, txn=None):
+        """Train a dictionary of at most `size` bytes from `samples`, an
+        iterable of encoded record values, persist it and use it for
+        subsequently packed values. Returns the new dictionary ID. Previous
+        dictionaries are retained so existing values remain readable.
+
+        The dictionary is kept in memory, so this instance may use it before
+        `txn` commits. Other instances adopt it when they first read a value
+        packed with it."""
+        assert 0 < size <= 32768, 'size must be 1..32768.'
+        zdict = _train_zdict(list(samples), size)
+        dict_id = 1 + self._last_id(txn)
+        self.store._dict_coll.put((self.name, dict_id, zdict), txn=txn)
+        self._states[dict_id] = self._prime(zdict)
+        self.dict_id = dict_id
+        return dict_id
+
+    def _last_id(self, txn):
+        keys = self.store._dict_coll.keys(lo=(self.name,), txn=txn)
+        return max([k[1] for k in itertools.takewhile(
+            lambda k: k[0] == self.name, keys)] or [0])
+
+class LruCache(object):
+    """A mapping that discards its least recently used entries once it exceeds
+    a maximum entry count and/or total size. At least one limit must be given.
+
+        `max_items`:
+            Maximum number of entries, or ``None`` for no limit.
+
+        `max_bytes`:
+            Maximum sum of the `size` given to :py:meth:`put` for each entry,
+            or ``None`` for no limit.
+
+    ::
+
+        cache = centidb.LruCache(max_bytes=64 * 1048576)
+        coll = centidb.Collection(store, 'logs', batch_cache=cache)
+        # ...
+        print 'hits: %d misses: %d' % (cache.hits, cache.misses)
+    """
+    def __init__(self, max_items=None, max_bytes=None):
+        assert max_items or max_bytes, 'max_items and/or max_bytes is required.'
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        #: Number of lookups that returned an entry.
+        self.hits = 0
+        #: Number of lookups that found no entry, or a stale one.
+        self.misses = 0
+        #: Sum of the sizes of all entries.
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, token=None):
+        """Return the value associated with `key`, marking it most recently
+        used, or ``None`` if it does not exist. If the entry was stored with a
+        `token` that differs from `token`, it is discarded and ``None`` is
+        returned."""
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] != token:
+            if entry:
+                self.size -= entry[2]
+            self.misses += 1
+            return
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, size=1, token=None):
+        """Associate `value` with `key`, evicting older entries as necessary.
+        `size` is the entry's contribution towards `max_bytes`, and `token`
+        is any value that must match during :py:meth:`get`, such as the
+        bytestring `value` was derived from."""
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        entries = self._entries
+        entries[key] = (token, value, size)
+        self.size += size
+        while ((self.max_items is not None and len(entries) > self.max_items)
+               or (self.max_bytes is not None and self.size > self.max_bytes)):
+            self.size -= entries.popitem(last=False)[1][2]
+
+    def pop(self, key):
+        """Discard any entry associated with `key`."""
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[2]
+
+    def clear(self):
+        """Discard all entries. Counters are preserved."""
+        self._entries.clear()
+        self.size = 0
+
+
+class BloomFilter(object):
+    """In-memory probabilistic set of the record keys and index tuples present
+    in a :py:class:`Collection`, allowing :py:meth:`Collection.get`,
+    :py:meth:`Collection.put` and :py:meth:`Index.has` to skip searching the
+    storage engine for keys that definitely do not exist, though
+    :py:meth:`Index.has` still makes the single seek checking the index is
+    built. Pass an instance as the `bloom=` argument of :py:class:`Collection`;
+    each collection requires its own filter.
+
+    When the collection is opened, the filter is loaded from
+    :py:class:`Store` metadata if :py:meth:`save` was called since the
+    collection was last written, otherwise it is rebuilt by a key-only scan.
+    Index tuples are likewise loaded, or scanned as each index is added.
+    Deleted keys are never removed, so the false positive rate slowly rises
+    until :py:meth:`rebuild` is called.
+
+        `capacity`:
+            Number of record keys and index tuples the filter is sized for.
+            Exceeding it raises the false positive rate.
+
+        `error_rate`:
+            Desired false positive rate at `capacity`.
+
+    *Note:* the filter observes only writes made through its own
+    :py:class:`Collection`. It must not be used if other processes or
+    :py:class:`Collection` instances write to the same collection, since keys
+    they add would be reported missing.
+
+    ::
+
+        coll = centidb.Collection(store, 'people',
+            bloom=centidb.BloomFilter(1000000))
+        # ...
+        coll.bloom.save()
+    """
+    #: Bytes of the filter stored in each :py:class:`Store` metadata record.
+    SEGMENT_SIZE = 4096
+
+    def __init__(self, capacity, error_rate=0.01):
+        nbits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        size = max(1, int(math.ceil(nbits / 8)))
+        #: Size of the filter in bits.
+        self.nbits = size * 8
+        #: Bits set for each key.
+        self.nhashes = max(1, int(round(self.nbits * math.log(2) / capacity)))
+        self.bits = bytearray(size)
+        self.coll = None
+        self._dirty = set()
+        self._indexed = set()
+        self._saved = False
+
+    def _positions(self, s):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(s).digest())
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in xrange(self.nhashes)]
+
+    def __contains__(self, s):
+        """Return ``False`` if the bytestring `s` was definitely never added
+        to the filter."""
+        bits = self.bits
+        for pos in self._positions(s):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, s):
+        """Add the bytestring `s` to the filter."""
+        bits = self.bits
+        seg_bits = self.SEGMENT_SIZE * 8
+        for pos in self._positions(s):
+            bits[pos >> 3] |= 1 << (pos & 7)
+            self._dirty.add(pos // seg_bits)
+
+    def _open(self, coll):
+        assert self.coll is None, 'BloomFilter already belongs to a Collection.'
+        self.coll = coll
+        self._name = '\x00bloom:%s' % (coll.info['name'],)
+        meta = coll.store._meta_coll
+        self._header = encode_keys(meta.prefix, self._name)
+        if not self._load(meta):
+            self._scan_records(None)
+
+    def _load(self, meta):
+        # Replace the filter with the saved copy, returning True on success.
+        tup = meta.get(self._name)
+        self._saved = tup is not None
+        if not tup or tup[1:3] != (self.nbits, self.nhashes):
+            return False
+        segs = []
+        for seg in xrange(self._segments()):
+            stored = meta.get('%s:%d' % (self._name, seg))
+            if not stored:
+                return False
+            segs.append(stored[1])
+        self.bits = bytearray(''.join(segs))
+        self._indexed = set(tup[3:])
+        return True
+
+    def _segments(self):
+        return (len(self.bits) + self.SEGMENT_SIZE - 1) // self.SEGMENT_SIZE
+
+    def _scan_records(self, txn):
+        coll = self.coll
+        for key in coll.keys(txn=txn):
+            self.add(encode_keys(coll.prefix, key))
+        self._dirty = set(xrange(self._segments()))
+
+    def _scan_index(self, index, txn):
+        # Add the index tuple of every entry in `index`.
+        prefix = index.prefix
+        it = itertools.takewhile(lambda item: item[0].startswith(prefix),
+                                 (txn or self.coll.engine).iter(prefix, False))
+        for index_key, _ in it:
+            _, key = index._decode(index_key)
+            self.add(index_key[:-len(encode_keys('', key))])
+        self._indexed.add(index.info['name'])
+
+    def _add_record(self, txn, phys, key, index_keys):
+        # Add a record's physical key, if any, and the index tuples of
+        # `index_keys`. Any saved copy no longer reflects the collection, so
+        # discard it, once.
+        if self._saved:
+            (txn or self.coll.engine).delete(self._header)
+            self._saved = False
+        if phys is not None:
+            self.add(phys)
+        n = len(encode_keys('', key))
+        for index_key in index_keys:
+            self.add(index_key[:-n])
+
+    def rebuild(self, txn=None):
+        """Clear the filter and repopulate it from the collection's records
+        and index entries, dropping keys deleted since it was built."""
+        self.bits = bytearray(len(self.bits))
+        self._indexed = set()
+        self._scan_records(txn)
+        for index in self.coll.indices.itervalues():
+            self._scan_index(index, txn)
+
+    def save(self, txn=None):
+        """Write the filter to :py:class:`Store` metadata in segments of
+        :py:attr:`SEGMENT_SIZE` bytes, rewriting only segments changed since it
+        was last loaded or saved. The next :py:class:`Collection` opened with
+        an identically sized filter loads it rather than scanning keys,
+        unless the collection is written first.
+
+        The first write following :py:meth:`save` discards the saved copy in
+        its transaction. If that transaction is aborted, call :py:meth:`save`
+        again, otherwise the saved copy may later be loaded while missing
+        keys written since."""
+        meta = self.coll.store._meta_coll
+        size = self.SEGMENT_SIZE
+        for seg in sorted(self._dirty):
+            meta.put(('%s:%d' % (self._name, seg),
+                      str(self.bits[seg * size:(seg + 1) * size])), txn=txn)
+        meta.put((self._name, self.nbits, self.nhashes) +
+                 tuple(sorted(self._indexed)), txn=txn)
+        self._dirty.clear()
+        self._saved = True
+
+#: :py:class:`Field` flags, shared with the speedups module.
+FIELD_LOWER = 1
+FIELD_INVERTED = 2
+
+class Field(object):
+    """Describes a field of dict records for use in a declarative index spec
+    passed to :py:meth:`Collection.add_index`. Field names alone may be given
+    as strings instead.
+
+        `name`:
+            Dict key of the field.
+
+        `lower`:
+            If ``True``, index the result of the value's ``lower()`` method.
+
+        `inverted`:
+            If ``True``, index the value with its bits inverted using
+            :py:func:`invert`, so it sorts in descending order. The value must
+            be a bytestring.
+    """
+    def __init__(self, name, lower=False, inverted=False):
+        self.name = name
+        self.flags = ((FIELD_LOWER if lower else 0) |
+                      (FIELD_INVERTED if inverted else 0))
+
+def _compile_spec(spec):
+    """Given a declarative index spec, return `(func, spec)`, where `func`
+    evaluates it in Python and `spec` is the `(fields, single)` form evaluated
+    by the speedups module, with `fields` a tuple of `(name, flags)`. Return
+    `(spec, None)` if `spec` is a function."""
+    if callable(spec):
+        return spec, None
+    single = not isinstance(spec, (tuple, list))
+    fields = []
+    for field in (spec,) if single else spec:
+        if isinstance(field, basestring):
+            field = Field(field)
+        elif not isinstance(field, Field):
+            raise TypeError('index spec fields must be field names or Field '
+                            'instances, not %r' % (field,))
+        fields.append((field.name, field.flags))
+    fields = tuple(fields)
+
+    def func(obj):
+        values = []
+        for name, flags in fields:
+            value = obj[name]
+            if flags & FIELD_LOWER:
+                value = value.lower()
+            if flags & FIELD_INVERTED:
+                if type(value) is not str:
+                    raise TypeError('inverted field %r must be a bytestring'
+                                    % (name,))
+                value = invert(value)
+            values.append(value)
+        return values[0] if single else tuple(values)
+    return func, (fields, single)
+
 class Index(object):
     """Provides query and manipulation access to a single index on a
     Collection. You should not create this class directly, instead use
@@ -403,16 +1035,47 @@ class Index(object):
         `max`:
             Maximum number of index records to return.
     """
-    def __init__(self, coll, info, func):
+    def __init__(self, coll, info, func, covered=None, unique=False):
         self.coll = coll
         self.store = coll.store
         self.engine = self.store.engine
         self.info = info
-        self.func = func
+        self.func, self.spec = _compile_spec(func)
+        self.covered = covered
+        self.unique = unique
         self.prefix = self.store.prefix + encode_int(info['idx'])
         self._decode = functools.partial(decode_keys, self.prefix)
 
-    def _iter(self, txn, key, lo, hi, reverse, max, include):
+    @property
+    def building(self):
+        """``True`` while an :py:class:`IndexBuilder` is populating the index,
+        during which queries raise :py:exc:`ValueError`. Read from the build's
+        progress saved in :py:class:`Store` metadata, so builds started or
+        finished by other instances are seen."""
+        return self._building(None)
+
+    def _building(self, txn):
+        meta = self.store._meta_coll
+        return meta.get(self.info['name'], txn=txn) is not None
+
+    def _check_built(self, txn=None):
+        # Consult the saved progress in the query's transaction, so a build
+        # slice is only trusted once it commits.
+        if self._building(txn):
+            raise ValueError('%r is being built, see IndexBuilder'
+                             % (self.info['name'],))
+
+    def _cover(self, obj):
+        """Return the index entry value for the record value `obj`: the
+        packed, encoded output of the `covered` function, or the empty string
+        if the index is not covered."""
+        if self.covered is None:
+            return ''
+        coll = self.coll
+        return coll._pack(coll.packer, coll.encoder.pack(self.covered(obj)))
+
+    def _iter(self, txn, key, lo, hi, reverse, max, include, values=False):
+        self._check_built(txn)
         if lo is None:
             lo = self.prefix
         else:
@@ -443,14 +1106,18 @@ class Index(object):
         else:
             it = (txn or self.engine).iter(lo, False)
             pred = hi.__ge__ if include else hi.__gt__
-        it = itertools.takewhile(pred, it)
+        it = itertools.takewhile(lambda item: pred(item[0]), it)
         if max is not None:
             it = itertools.islice(it, max)
-        for key, _ in it:
-            key = self._decode(key)
-            if not key:
-                break
-            yield key
+        for chunk in _chunks(it):
+            keys = decode_keys_many(self.prefix, [k for k, _ in chunk])
+            if values:
+                keys = itertools.izip(keys, itertools.imap(ITEMGETTER_1,
+                                                           chunk))
+            for key in keys:
+                if not (key[0] if values else key):
+                    return
+                yield key
 
     def pairs(self, args=None, lo=None, hi=None, reverse=None, max=None,
             include=False, txn=None):
@@ -476,25 +1143,78 @@ class Index(object):
             self.pairs(args, lo, hi, reverse, max, include, txn))
 
     def items(self, args=None, lo=None, hi=None, reverse=None, max=None,
-            include=False, txn=None, rec=False):
+            include=False, txn=None, rec=False, window=None, key_order=False):
         """Yield all `(key, value)` items referred to by the index, in tuple
         order. If `rec` is ``True``, :py:class:`Record` instances are yielded
-        instead of record values."""
-        for idx_key, key in self.pairs(args, lo, hi, reverse, max,
-                                       include, txn):
-            obj = self.coll.get(key, txn=txn, rec=rec)
+        instead of record values.
+
+            `window`:
+                If specified, rather than looking up each record separately,
+                buffer up to `window` index entries at a time and read their
+                records in key order using a single forward iterator, seeking
+                it to each key and decoding each batch once. This is much
+                faster when matching records are clustered in key order.
+
+            `key_order`:
+                If ``True`` and `window` is specified, yield items in key order
+                within each window, rather than tuple order.
+        """
+        keys = self.keys(args, lo, hi, reverse, max, include, txn)
+        if window:
+            it = self._merge_join(keys, txn, rec, window, key_order)
+        else:
+            it = ((key, self.coll.get(key, txn=txn, rec=rec)) for key in keys)
+        for key, obj in it:
             if obj:
                 yield key, obj
             else:
                 warnings.warn('stale entry in %r, requires rebuild' % (self,))
 
+    def _merge_join(self, keys, txn, rec, window, key_order):
+        """Yield `(key, obj)` for each key in `keys`, where `obj` is ``None``
+        if the record is missing. Keys are read in chunks of `window`, each
+        chunk being satisfied by :py:meth:`Collection.gets`, which seeks one
+        forward iterator to each of its sorted keys."""
+        keys = iter(keys)
+        while True:
+            chunk = list(itertools.islice(keys, window))
+            if not chunk:
+                return
+            found = self.coll.gets(chunk, None, rec, txn, key_order)
+            if not key_order:
+                found = itertools.izip(chunk, found)
+            for key, obj in found:
+                yield key, obj
+
     def values(self, args=None, lo=None, hi=None, reverse=None, max=None,
-            include=False, txn=None, rec=None):
+            include=False, txn=None, rec=None, window=None, key_order=False):
         """Yield all values referred to by the index, in tuple order. If `rec`
         is ``True``, :py:class:`Record` instances are yielded instead of record
-        values."""
+        values. `window` and `key_order` are as for :py:meth:`items`."""
         return itertools.imap(ITEMGETTER_1,
-            self.items(args, lo, hi, reverse, max, include, txn, rec))
+            self.items(args, lo, hi, reverse, max, include, txn, rec,
+                       window, key_order))
+
+    def projections(self, args=None, lo=None, hi=None, reverse=None,
+            max=None, include=False, txn=None):
+        """Yield `(key, projection)` for each record referred to by a covered
+        index, in tuple order, where `projection` is the output of the index's
+        `covered` function. Projections are read from the index entries
+        themselves, so no collection lookups occur, except for entries written
+        before `covered` was specified."""
+        assert self.covered is not None, '%r is not covered' % (self,)
+        decompress = self.coll._decompress
+        unpack = self.coll.encoder.unpack
+        for (idx_key, key), value in self._iter(txn, args, lo, hi, reverse,
+                                                max, include, True):
+            if value:
+                yield key, unpack(decompress(value))
+                continue
+            obj = self.coll.get(key, txn=txn)
+            if obj is None:
+                warnings.warn('stale entry in %r, requires rebuild' % (self,))
+            else:
+                yield key, self.covered(obj)
 
     def find(self, args=None, lo=None, hi=None, reverse=None, include=False,
              txn=None, rec=None, default=None):
@@ -509,9 +1229,20 @@ class Index(object):
     def has(self, x, txn=None):
         """Return True if an entry with the exact tuple `x` exists in the
         index."""
-        x = tuplize(x)
-        tup, key = next(self.pairs(x), (None, None))
-        return tup == x
+        self._check_built(txn)
+        probe = encode_keys(self.prefix, tuplize(x)) + KIND_SEP
+        bloom = self.coll.bloom
+        if bloom and probe not in bloom:
+            return False
+        return self._probe(txn, probe) is not None
+
+    def _probe(self, txn, probe):
+        """Return the first index entry key beginning with `probe`, an index
+        entry key prefix ending with the index tuple, using a single engine
+        seek, or ``None``."""
+        key, _ = next((txn or self.engine).iter(probe, False), (None, None))
+        if key is not None and key.startswith(probe):
+            return key
 
     def get(self, x, txn=None, rec=None, default=None):
         """Return the first matching record referred to by the index, in tuple
@@ -527,6 +1258,231 @@ class Index(object):
         """Yield `get(x)` for each `x` in the iterable `xs`."""
         return (self.get(x, txn, rec, default) for x in xs)
 
+    def rebuild(self, txn=None, clear=True):
+        """Populate the index from every record in the collection using a
+        single call, returning the :py:class:`IndexBuilder` used. Use
+        :py:class:`IndexBuilder` directly to spread the work over many
+        transactions."""
+        builder = IndexBuilder(self)
+        builder.start(txn, clear)
+        while not builder.step(txn):
+            pass
+        return builder
+
+class _QueryCursor(object):
+    # Position within a stream of `(encoded key, key)` pairs in key order, or
+    # reverse key order. `open(start)` returns the stream beginning at the
+    # first pair not before the pair `start`. seek() first steps through the
+    # current stream, since the target is often near, before reopening it.
+    SEEK_STEPS = 8
+
+    def __init__(self, open_, reverse):
+        self.open = open_
+        self.before = operator.gt if reverse else operator.lt
+        self.it = open_(None)
+        self.head = next(self.it, None)
+
+    def next(self):
+        self.head = next(self.it, None)
+
+    def seek(self, target):
+        for _ in xrange(self.SEEK_STEPS):
+            if self.head is None or not self.before(self.head[0], target[0]):
+                return
+            self.head = next(self.it, None)
+        if self.head is not None and self.before(self.head[0], target[0]):
+            self.it = self.open(target)
+            self.head = next(self.it, None)
+
+
+class Query(object):
+    """Describes a set of records from a single collection, formed by
+    intersecting and unioning index lookups. Queries are combined using the
+    ``&`` and ``|`` operators, or :py:meth:`Query.all` and
+    :py:meth:`Query.any`. Record keys are merged as streams in key order,
+    with intersections seeking each index ahead to the next candidate key,
+    so only records matching the whole query are fetched.
+
+        `index`:
+            :py:class:`Index` to query.
+
+        `value`:
+            If not ``None``, match records whose index entry tuple equals
+            `value`. Matches are read from the index in key order, so may be
+            merged without buffering.
+
+        `lo`, `hi`, `include`:
+            Otherwise match records with an index entry in the given range, as
+            for :py:meth:`Index.keys`. Matching keys are read and sorted before
+            merging.
+
+    ::
+
+        people = Collection(store, 'people')
+        city = people.add_index('city', lambda p: p['city'])
+        age = people.add_index('age', lambda p: p['age'])
+
+        q = Query(city, 'London') & (Query(age, lo=20, hi=29) |
+                                     Query(age, lo=60, hi=69))
+        for person in q.values(max=10):
+            print person['name']
+    """
+    def __init__(self, index, value=None, lo=None, hi=None, include=False):
+        self.coll = index.coll
+        if value is not None:
+            value = tuplize(value)
+            self._opener = functools.partial(self._value_opener, index, value)
+        else:
+            self._opener = functools.partial(self._range_opener, index,
+                                             lo, hi, include)
+
+    # Each `_opener(txn, reverse)` returns an `open(start)` function for
+    # _QueryCursor.
+
+    @staticmethod
+    def _value_opener(index, value, txn, reverse):
+        # Entries for `value` all begin with `probe`, followed by the encoded
+        # record key. Reverse streams seek just past them, skipping the greater
+        # key the engine may yield first, and every stream stops as soon as the
+        # prefix no longer matches.
+        index._check_built(txn)
+        probe = encode_keys(index.prefix, value) + KIND_SEP
+        engine = txn or index.engine
+        def open_(start):
+            if start is not None:
+                seek = probe + start[0]
+            else:
+                seek = next_greater(probe) if reverse else probe
+            it = engine.iter(seek, reverse)
+            if reverse:
+                it = itertools.dropwhile(lambda item: item[0] > seek, it)
+            it = itertools.takewhile(lambda item: item[0].startswith(probe),
+                                     it)
+            for chunk in _chunks(it):
+                encs = [k[len(probe):] for k, _ in chunk]
+                for enc, keys in itertools.izip(encs,
+                                                decode_keys_many('', encs)):
+                    yield enc, keys[0]
+        return open_
+
+    @staticmethod
+    def _range_opener(index, lo, hi, include, txn, reverse):
+        pairs = sorted(set((encode_keys('', key), key)
+                           for key in index.keys(None, lo, hi, None, None,
+                                                 include, txn)))
+        encs = [enc for enc, _ in pairs]
+        def open_(start):
+            if reverse:
+                end = len(pairs)
+                if start is not None:
+                    end = bisect.bisect_right(encs, start[0])
+                return itertools.imap(pairs.__getitem__,
+                                      xrange(end - 1, -1, -1))
+            pos = 0 if start is None else bisect.bisect_left(encs, start[0])
+            return itertools.islice(pairs, pos, None)
+        return open_
+
+    @classmethod
+    def _combine(cls, queries, merge):
+        assert len(set(q.coll for q in queries)) == 1, \
+            'queries must be for the same collection'
+        query = cls.__new__(cls)
+        query.coll = queries[0].coll
+        def opener(txn, reverse):
+            openers = [q._opener(txn, reverse) for q in queries]
+            def open_(start):
+                cursors = [_QueryCursor(child, reverse) for child in openers]
+                if start is not None:
+                    for cursor in cursors:
+                        cursor.seek(start)
+                return merge(cursors)
+            return open_
+        query._opener = opener
+        return query
+
+    @staticmethod
+    def _intersect(cursors):
+        # Leapfrog join: seek every cursor to the furthest head, until all
+        # heads agree.
+        before = cursors[0].before
+        while True:
+            heads = [c.head for c in cursors]
+            if None in heads:
+                return
+            target = heads[0]
+            for head in heads:
+                if before(target[0], head[0]):
+                    target = head
+            if all(head[0] == target[0] for head in heads):
+                yield target
+                cursors[0].next()
+            else:
+                for cursor in cursors:
+                    cursor.seek(target)
+
+    @staticmethod
+    def _union(cursors):
+        before = cursors[0].before
+        while True:
+            heads = [c.head for c in cursors if c.head is not None]
+            if not heads:
+                return
+            first = heads[0]
+            for head in heads:
+                if before(head[0], first[0]):
+                    first = head
+            yield first
+            for cursor in cursors:
+                if cursor.head is not None and cursor.head[0] == first[0]:
+                    cursor.next()
+
+    @classmethod
+    def all(cls, *queries):
+        """Return a query matching records matched by every query in
+        `queries`."""
+        return cls._combine(queries, cls._intersect)
+
+    @classmethod
+    def any(cls, *queries):
+        """Return a query matching records matched by any query in
+        `queries`."""
+        return cls._combine(queries, cls._union)
+
+    def __and__(self, other):
+        return Query.all(self, other)
+
+    def __or__(self, other):
+        return Query.any(self, other)
+
+    def keys(self, reverse=False, max=None, txn=None):
+        """Yield matching record keys in key order, or reverse key order if
+        `reverse` is ``True``, up to a total of `max` keys."""
+        it = self._opener(txn, reverse)(None)
+        if max is not None:
+            it = itertools.islice(it, max)
+        return itertools.imap(ITEMGETTER_1, it)
+
+    def items(self, reverse=False, max=None, txn=None, rec=False):
+        """Yield `(key, value)` for matching records in key order. If `rec` is
+        ``True``, :py:class:`Record` instances are yielded instead of record
+        values."""
+        for key in self.keys(reverse, max, txn):
+            obj = self.coll.get(key, txn=txn, rec=rec)
+            if obj is None:
+                warnings.warn('stale entry in %r, requires rebuild' % (self,))
+            else:
+                yield key, obj
+
+    def values(self, reverse=False, max=None, txn=None, rec=False):
+        """Yield matching record values in key order. If `rec` is ``True``,
+        :py:class:`Record` instances are yielded instead of record values."""
+        return itertools.imap(ITEMGETTER_1,
+                              self.items(reverse, max, txn, rec))
+
+
+# Record.data of a lazily loaded record that has not been decoded yet.
+_UNDECODED = object()
+
 class Record(object):
     """Wraps a record value with its last saved key, if any.
 
@@ -542,19 +1498,25 @@ class Record(object):
     to first check for any existing record with the same key, and therefore for
     any existing index keys that must first be deleted.
 
+    Records produced by iteration, such as ``Collection.items(rec=True)``,
+    are loaded lazily: they retain the encoded value, decoding it when
+    :py:attr:`Record.data` is first accessed, and run the collection's index
+    functions against a fresh decoding of it only when
+    :py:meth:`Collection.put` or :py:meth:`Collection.delete` needs the
+    record's old index keys.
+
     *Note:* you may create :py:class:`Record` instances directly, **but you
     must not modify any attributes except** :py:attr:`Record.data`, or
     construct it using any arguments except `coll` and `data`, otherwise index
     corruption will likely occur.
     """
     def __init__(self, coll, data, _key=None, _batch=False,
-            _txn_id=None, _index_keys=None):
+            _txn_id=None, _index_keys=None, _raw=None):
         #: :py:class:`Collection` this record belongs to. This is always reset
         #: after a successful :py:meth:`Collection.put`.
         self.coll = coll
-        #: The actual record value. This may be user-supplied Python object
-        #: recognized by the collection's value encoder.
-        self.data = data
+        self._data = _UNDECODED if _raw is not None else data
+        self._raw = _raw
         #: Key for this record when it was last saved, or ``None`` if the
         #: record is deleted or has never been saved.
         self.key = _key
@@ -565,7 +1527,36 @@ class Record(object):
         #: Transaction ID this record was visible in. Used internally to
         #: ensure records from distinct transactions aren't mixed.
         self.txn_id = _txn_id
-        self.index_keys = _index_keys
+        self._index_keys = _index_keys
+
+    @property
+    def data(self):
+        """The actual record value. This may be user-supplied Python object
+        recognized by the collection's value encoder."""
+        if self._data is _UNDECODED:
+            self._data = self.coll.encoder.unpack(self._raw)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def index_keys(self):
+        """Sorted index entry keys of the record when it was loaded or last
+        saved, computed from its encoded value on first use if it was loaded
+        lazily."""
+        if self._index_keys is None and self._raw is not None and self.key:
+            coll = self.coll
+            self._index_keys = coll._index_keys(self.key,
+                                                coll.encoder.unpack(self._raw))
+        return self._index_keys
+
+    @index_keys.setter
+    def index_keys(self, index_keys):
+        self._index_keys = index_keys
+        if self._data is not _UNDECODED:
+            self._raw = None
 
     def __eq__(self, other):
         return isinstance(other, Record) and \
@@ -576,6 +1567,151 @@ class Record(object):
         s = ','.join(map(repr, self.key or ()))
         return '<Record %s:(%s) %r>' % (self.coll.info['name'], s, self.data)
 
+class _BatchSizer(object):
+    """Track the packed size of a batch as members are appended to it,
+    avoiding a full repack after each append.
+
+    Each repack measures the ratio of packed to raw bytes, and further appends
+    are charged at that ratio. The batch is only repacked again once the
+    estimate suggests one more average member would exceed `max_bytes`, so
+    the cost of building a batch is a small constant number of packs rather
+    than one per member.
+    """
+    def __init__(self, coll, packer, max_bytes, block_size):
+        self.coll = coll
+        self.packer = packer
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._reset()
+
+    def _reset(self):
+        # Number of items seen, and the last count known to fit.
+        self.count = self.good = 0
+        # Raw bytes seen, and raw bytes at the last repack.
+        self.raw = self.raw_packed = 0
+        # Output of the last repack, describing items[:good].
+        self.prepared = None
+        self.ratio = 1.0
+        self.next_check = 0
+
+    def _prepare(self, items):
+        return self.coll._prepare_batch(items, self.packer, self.block_size)
+
+    def fits(self, items):
+        """Return ``True`` if `items` is probably no larger than `max_bytes`
+        when packed. Must be called after each item is appended; a change in
+        length by other than one is taken to mean a new batch was started."""
+        new = items[-1:]
+        if len(items) != (self.count + 1):
+            self._reset()
+            new = items
+        self.count = len(items)
+        self.raw += sum(len(data) for _, data in new)
+        if self.prepared:
+            estimate = len(self.prepared[1]) + \
+                int((self.raw - self.raw_packed) * self.ratio)
+            if estimate < self.next_check:
+                return True
+
+        prepared = self._prepare(items)
+        size = len(prepared[1])
+        if size > self.max_bytes and self.count > 1:
+            return False
+        self.good = self.count
+        self.prepared = prepared
+        self.raw_packed = self.raw
+        self.ratio = size / float(self.raw or 1)
+        self.next_check = self.max_bytes - (size // self.count)
+        return True
+
+    def split(self, items):
+        """After :py:meth:`fits` returns ``False``, return `(n, prepared)`
+        where `n` is the largest count of leading `items` that fit, and
+        `prepared` is their :py:meth:`Collection._prepare_batch` output. Known
+        good counts are reused, otherwise a binary search is performed. A
+        single record is always considered to fit."""
+        lo = max(1, self.good)
+        prepared = self.prepared
+        hi = len(items) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            tmp = self._prepare(items[:mid])
+            if len(tmp[1]) > self.max_bytes:
+                hi = mid - 1
+            else:
+                lo = mid
+                prepared = tmp
+        return lo, prepared
+
+    def measure(self, items):
+        """Return the :py:meth:`Collection._prepare_batch` output for `items`
+        if it is no larger than `max_bytes`, otherwise ``None``. Unlike
+        :py:meth:`fits` the size is never estimated, so this is called before
+        the final batch of a run is written."""
+        if len(items) != self.count:
+            self._reset()
+            self.count = len(items)
+        if self.prepared and self.good == self.count:
+            return self.prepared
+        prepared = self._prepare(items)
+        if len(prepared[1]) <= self.max_bytes or self.count == 1:
+            return prepared
+
+def _cache_token(phys, value):
+    # Identify a physical record for record cache validation by a SHA-1
+    # digest, rather than retaining its value, which may be a large batch.
+    return phys, hashlib.sha1(value).digest()
+
+class _PureMembers(object):
+    """Sequence of encoded member keys for a "pure keys" batch, in descending
+    order like :py:func:`split_keys` output. Keys are recovered on demand by
+    applying the collection's key function to the member's value."""
+    def __init__(self, coll, count, member):
+        self.coll = coll
+        self.member = member
+        self.last = count - 1
+        self.keys = {}
+
+    def __len__(self):
+        return self.last + 1
+
+    def __getitem__(self, pos):
+        key = self.keys.get(pos)
+        if key is None:
+            obj = self.coll.encoder.unpack(self.member(self.last - pos))
+            key = encode_keys('', tuplize(self.coll.key_func(obj)))
+            self.keys[pos] = key
+        return key
+
+class _Budget(object):
+    # Limits a physical iterator to `max_phys` items and/or `max_time`
+    # seconds. `spent` is set if either limit ended iteration early.
+    def __init__(self, max_phys=None, max_time=None):
+        self.max_phys = max_phys
+        self.deadline = None if max_time is None else time.time() + max_time
+        self.spent = False
+        self.used = 0
+
+    def wrap(self, it):
+        for tup in it:
+            if (self.max_phys is not None and self.used >= self.max_phys) or \
+               (self.deadline is not None and time.time() >= self.deadline):
+                self.spent = True
+                return
+            self.used += 1
+            yield tup
+
+# Collection.batch(processes=...) worker state, inherited by forked workers.
+_batch_worker_args = None
+
+def _batch_worker_init(*args):
+    global _batch_worker_args
+    _batch_worker_args = args
+
+def _batch_worker(run):
+    coll, packer, max_bytes, block_size = _batch_worker_args
+    return coll._pack_run(run, packer, max_bytes, block_size)
+
 class Collection(object):
     """Provides access to a record collection contained within a
     :py:class:`Store`, and ensures associated indices update consistently when
@@ -655,10 +1791,51 @@ class Collection(object):
             unspecified, auto-incremented keys are a 1-tuple containing the
             counter value. Unused when `key_func` or `txn_key_func` are
             specified.
+
+        `batch_cache`:
+            Optional :py:class:`LruCache` used to retain decompressed batch
+            values, keyed by physical key, so repeated :py:meth:`get` calls for
+            members of a hot batch need not decompress it again. Entries are
+            validated against the value read from the engine, and are
+            invalidated by :py:meth:`put`, :py:meth:`delete` and
+            :py:meth:`batch`, so aborted transactions cannot leave stale
+            entries behind. A single cache may be shared by every collection in
+            a :py:class:`Store`.
+
+        `pure_keys`:
+            If ``True``, batches written by :py:meth:`batch` whose members'
+            keys all equal `key_func` applied to their values store only the
+            lowest and highest member keys in their physical key. Remaining
+            keys are recovered during lookup by decoding members as a binary
+            search proceeds, trading some CPU for much smaller keys, e.g. for
+            time series whose values contain their timestamp. Requires
+            `key_func`, which must not change once records are batched.
+
+        `bloom`:
+            Optional :py:class:`BloomFilter` of the collection's keys and
+            index tuples, populated during construction. Lookups of keys the
+            filter excludes skip the storage engine, so :py:meth:`put` of new
+            records to an indexed collection need not search for an old
+            record to replace.
+
+        `record_cache`:
+            Optional :py:class:`LruCache` used to retain encoded record
+            values, keyed by key tuple, so :py:meth:`get` of a hot record
+            costs only a single engine seek and a decode, avoiding the
+            physical record's decompression. Each entry is validated against
+            a SHA-1 digest of the physical record found by that seek, so
+            writes made by other transactions, including uncommitted or
+            aborted ones, are not returned unless their physical record's
+            digest collides with the cached one. Every hit digests the whole
+            physical record, which may be a batch. :py:meth:`put` updates the
+            cache, while :py:meth:`delete` and :py:meth:`batch` invalidate it.
+            Entry sizes count the encoded value. Every call returns a newly
+            decoded value.
     """
     def __init__(self, store, name, key_func=None, txn_key_func=None,
             derived_keys=False, virgin_keys=False, encoder=None, packer=None,
-            _idx=None, counter_name=None, counter_prefix=None):
+            _idx=None, counter_name=None, counter_prefix=None,
+            batch_cache=None, pure_keys=False, bloom=None, record_cache=None):
         """Create an instance; see class docstring."""
         self.store = store
         self.engine = store.engine
@@ -666,6 +1843,9 @@ class Collection(object):
             self.info = {'name': name, 'idx': _idx, 'index_for': None}
         else:
             self.info = store._get_info(name, idx=_idx)
+        # Store metadata collections are never batched, so :py:meth:`put`
+        # need not search them for a batch covering a new key.
+        self._unbatched = _idx is not None
         self.prefix = store.prefix + encode_int(self.info['idx'])
         if not (key_func or txn_key_func):
             counter_name = counter_name or ('key:%(name)s' % self.info)
@@ -674,8 +1854,10 @@ class Collection(object):
                 (counter_prefix + (store.count(counter_name, txn=txn),))
             derived_keys = False
             virgin_keys = True
+        assert key_func or not pure_keys, 'pure_keys requires key_func.'
         self.key_func = key_func
         self.txn_key_func = txn_key_func
+        self.pure_keys = pure_keys
         self.derived_keys = derived_keys
         self.virgin_keys = virgin_keys
         self.encoder = encoder or PICKLE_ENCODER
@@ -683,6 +1865,11 @@ class Collection(object):
         #: Default packer used when calls to :py:meth:`Collection.put` do not
         #: specify a `packer=` argument. Defaults to ``PLAIN_PACKER``.
         self.packer = packer or PLAIN_PACKER
+        self.store.add_encoder(self.packer)
+        #: :py:class:`LruCache` of decompressed batches, or ``None``.
+        self.batch_cache = batch_cache
+        #: :py:class:`LruCache` of decoded record values, or ``None``.
+        self.record_cache = record_cache
         #: Dict mapping indices added using :py:meth:`Collection.add_index` to
         #: :py:class:`Index` instances representing them.
         #:
@@ -691,8 +1878,13 @@ class Collection(object):
         #:      idx = coll.add_index('some index', lambda v: v[0])
         #:      assert coll.indices['some index'] is idx
         self.indices = {}
+        self._unique = []
+        #: :py:class:`BloomFilter` of the collection's keys, or ``None``.
+        self.bloom = bloom
+        if bloom:
+            bloom._open(self)
 
-    def add_index(self, name, func):
+    def add_index(self, name, func, covered=None, unique=False):
         """Associate an index with the collection. Index metadata will be
         created in the storage engine it it does not exist. Returns the `Index`
         instance describing the index. This method may only be invoked once for
@@ -709,7 +1901,26 @@ class Collection(object):
             Index key generation function accepting one argument, the record
             value. It should return a single primitive value, a tuple of
             primitive values, a list of primitive values, or a list of tuples
-            of primitive values.
+            of primitive values. Records for which it returns :py:data:`SKIP`
+            or an empty list have no entry in the index, so partial indices
+            over a small subset of records cost nothing to maintain for the
+            remainder:
+
+            ::
+
+                coll.add_index('pending',
+                    lambda job: job['created'] if job['pending'] else SKIP)
+
+            For dict records, `func` may instead be a declarative spec: a
+            field name or :py:class:`Field`, producing that field's value, or
+            a tuple or list of them, producing a tuple of values. With speedups
+            enabled, specs are evaluated without calling any Python code,
+            which is significantly faster:
+
+            ::
+
+                coll.add_index('name', 'name')
+                coll.add_index('city_name', ('city', Field('name', lower=True)))
 
             `Note:` the index function must have no side-effects. Example:
 
@@ -730,49 +1941,153 @@ class Collection(object):
                     (('Charles',),  (3,)),
                     (('David',),    (1,))
                 ]
+
+        `covered`:
+            If specified, a function accepting one argument, the record value,
+            and returning a projection of it to be stored alongside each index
+            entry, encoded using the collection's encoder and compressed using
+            its packer. :py:meth:`Index.projections` then answers queries
+            needing only the projected fields using a single index scan.
+            Entries written before `covered` was specified are stored without
+            a projection until the record is next saved.
+
+            ::
+
+                index = coll.add_index('age', lambda person: person['age'],
+                    covered=lambda person: person['name'])
+
+                # [((1,), u'Charles'), ((2,), u'David'), ...]
+                it = index.projections(lo=20, hi=40)
+
+        `unique`:
+            If ``True``, :py:meth:`Collection.put` raises :py:exc:`ValueError`
+            rather than saving a record producing an index tuple already
+            produced by a different record. Each index tuple is checked using
+            a single engine seek. Existing entries are not checked.
+
+        If the index is new but the collection already contains records, the
+        index is marked as building, and must be populated using
+        :py:meth:`Index.rebuild` or :py:class:`IndexBuilder` before it can be
+        queried.
         """
         assert name not in self.indices
         info_name = 'index:%s:%s' % (self.info['name'], name)
+        existed = self.store._info_coll.get(info_name) is not None
         info = self.store._get_info(info_name, index_for=self.info['name'])
-        index = Index(self, info, func)
+        index = Index(self, info, func, covered, unique)
+        if unique:
+            self._unique.append(index)
+        if not (existed or index.building) and \
+                next(self.keys(max=1), None) is not None:
+            IndexBuilder(index).start(clear=False)
         self.indices[name] = index
+        if self.bloom and info['name'] not in self.bloom._indexed:
+            self.bloom._scan_index(index, None)
         if IndexKeyBuilder:
             self._index_keys = IndexKeyBuilder(self.indices.values()).build
         return index
 
-    def _logical_iter(self, it, reverse):
+    def _logical_iter(self, it, reverse, lo, hi, include, max_, keys_only,
+                      batch_values):
         #   * When iterating forward, if first yielded key lacks collection
         #     prefix, result of iteration is empty.
         #   * When iterating reverse, if first yielded key lacks collection
         #     prefix, discard, then behave as forward.
-        #   * Records are discarded in the direction of iteration until
-        #     startpred() or not self.prefix.
-        #   * Records are yielded following startpred() until not endpred() or
-        #     not self.prefix.
+        #   * Members are discarded in the direction of iteration until they
+        #     fall within `lo..hi`.
+        #   * Members are yielded until one falls outside `lo..hi`, or a
+        #     physical key lacks self.prefix.
+        #   * `lo` and `hi` are encode_keys('', ...) output; comparisons
+        #     happen on encoded bytes, so only yielded members are decoded.
+        #   * If `keys_only` is true, values are never decompressed and None
+        #     is yielded in their place, except for "pure keys" batches, whose
+        #     member keys are recovered from their values.
+        #   * If `batch_values` is false, None is yielded in place of batch
+        #     members' values.
+        #   * Members are located by binary search, so pure keys batches only
+        #     decode O(log n) values before reaching the range.
         tup = next(it, None)
         if tup and tup[0].startswith(self.prefix):
             it = itertools.chain((tup,), it)
-        for key, value in it:
-            keys = decode_keys(self.prefix, key)
-            if not keys:
-                return
 
-            lenk = len(keys)
-            if lenk == 1:
-                yield False, keys[0], self._decompress(value)
-            else: # Batch record.
-                offsets, dstart = decode_offsets(value)
-                data = self._decompress(buffer(value, dstart))
-                keys.reverse()
-                if reverse:
-                    rit = xrange(lenk - 1, -1, -1)
-                else:
-                    rit = xrange(lenk)
-                for i in rit:
-                    key = keys[i]
-                    offs = offsets[i]
-                    size = offsets[i+1] - offs
-                    yield True, key, buffer(data, offs, size)
+        # skip(m) is true while member `m` precedes the range in the
+        # direction of iteration, stop(m) once `m` has passed it.
+        if hi is None:
+            past_hi = None
+        else:
+            past_hi = hi.__lt__ if include else hi.__le__
+        before_lo = None if lo is None else lo.__gt__
+        skip, stop = (past_hi, before_lo) if reverse else (before_lo, past_hi)
+
+        n = 1
+        remain = max_
+        done = False
+        while not done:
+            if remain is not None:
+                n = min(n, remain)
+            chunk = list(itertools.islice(it, n))
+            if not chunk:
+                return
+            n = min(n * 2, CHUNK_SIZE)
+
+            hits = []
+            expanded = {}
+            for i, (phys, value) in enumerate(chunk):
+                members = split_keys(self.prefix, phys)
+                if members is None:
+                    done = True
+                    break
+                if len(members) == 2 and self.key_func \
+                        and decode_int_s(value) > 2:
+                    count, member = self._batch_reader(phys, value)
+                    expanded[i] = member
+                    members = _PureMembers(self, count, member)
+                # Physical keys list members in descending order.
+                last = len(members) - 1
+                order = range(last + 1) if reverse else range(last, -1, -1)
+                start = 0
+                if skip:
+                    end = last + 1
+                    while start < end:
+                        mid = (start + end) // 2
+                        if skip(members[order[mid]]):
+                            start = mid + 1
+                        else:
+                            end = mid
+                for pos in order[start:]:
+                    m = members[pos]
+                    if stop and stop(m):
+                        done = True
+                        break
+                    hits.append((i, last, last - pos, m))
+                    if remain is not None:
+                        remain -= 1
+                        done = not remain
+                        if done:
+                            break
+                if done:
+                    break
+
+            keys = decode_keys_many('', [m for _, _, _, m in hits])
+            if keys_only:
+                for (_, last, _, _), key in itertools.izip(hits, keys):
+                    yield bool(last), key[0], None
+                continue
+
+            cur = None
+            for (i, last, idx, _), key in itertools.izip(hits, keys):
+                value = chunk[i][1]
+                if not last:
+                    yield False, key[0], self._decompress(value)
+                    continue
+                if not batch_values:
+                    yield True, key[0], None
+                    continue
+                if i != cur: # Batch record.
+                    cur = i
+                    member = expanded.get(i) or \
+                        self._batch_reader(chunk[i][0], value)[1]
+                yield True, key[0], member(idx)
 
     # -----------------------------------------------------------
     # prefix: a
@@ -786,83 +2101,172 @@ class Collection(object):
     #  .iter(prefix)      |        .iter(next_greater(prefix))
     #                 .iter(ad)
     # -----------------------------------------------------------
-    # _iter(, , , False): lokey=prefix, hikey=ng(prefix)
-    #                     startpred=lokey, endpred=
-    def _iter(self, txn, key, lo, hi, reverse, max_, include, max_phys):
+    def _iter(self, txn, key, lo, hi, reverse, max_, include, budget,
+              keys_only=False, batch_values=True):
         if key is not None:
-            key = tuplize(key)
             if reverse:
                 hi = key
                 include = True
             else:
                 lo = key
 
-        if lo is None:
-            lokey = self.prefix
-        else:
-            lo = tuplize(lo)
-            lokey = encode_keys(self.prefix, lo)
+        if lo is not None:
+            lo = encode_keys('', tuplize(lo))
+        if hi is not None:
+            hi = encode_keys('', tuplize(hi))
 
-        if hi is None:
-            hikey = next_greater(self.prefix)
-            include = False
+        if not reverse:
+            startkey = self.prefix + (lo or '')
+        elif hi is not None:
+            startkey = self.prefix + hi
         else:
-            hi = tuplize(hi)
-            hikey = encode_keys(self.prefix, hi)
-
-        if reverse:
-            startkey = hikey
-            startpred = hi and (hi.__lt__ if include else hi.__le__)
-            endpred = lo and lo.__ge__
-        else:
-            startkey = lokey
-            startpred = None
-            endpred = hi and (hi.__ge__ if include else hi.__gt__)
+            startkey = next_greater(self.prefix)
 
         it = (txn or self.engine).iter(startkey, reverse)
-        if max_phys is not None:
-            it = itertools.islice(it, max_phys)
-
-        it = self._logical_iter(it, reverse)
-        if max_ is not None:
-            it = itertools.islice(it, max_)
-        if startpred:
-            it = itertools.dropwhile(_kcmp(startpred), it)
-        if endpred:
-            it = itertools.takewhile(_kcmp(endpred), it)
-        return it
+        if budget is not None:
+            it = budget.wrap(it)
+        return self._logical_iter(it, reverse, lo, hi, include, max_,
+                                  keys_only, batch_values)
+
+    def _batch_reader(self, phys, value):
+        """Return `(count, member)` for the batch record `phys` with value
+        `value`, where `member(idx)` returns a buffer containing the encoded
+        value of the member at ascending position `idx`. Blocked batches only
+        decompress the sub-blocks containing requested members."""
+        offsets, dstart = decode_offsets(value)
+        count = len(offsets) - 1
+        if value[dstart] != '\x00':
+            data = self._batch_data(phys, value, buffer(value, dstart))
+            def member(idx):
+                start = offsets[idx]
+                return buffer(data, start, offsets[idx + 1] - start)
+            return count, member
+
+        io = cStringIO.StringIO(value)
+        io.seek(dstart + 1)
+        getc = functools.partial(io.read, 1)
+        block_size = decode_int(getc, io.read)
+        encoder = self.store.get_encoder(getc())
+        starts = _block_starts(offsets, block_size)
+        lens = [decode_int(getc, io.read) for _ in starts]
+        ends = [io.tell()]
+        for n in lens:
+            ends.append(ends[-1] + n)
+        blocks = {}
+
+        def member(idx):
+            b = bisect.bisect_right(starts, idx) - 1
+            data = blocks.get(b)
+            if data is None:
+                packed = buffer(value, ends[b], ends[b + 1] - ends[b])
+                data = self._batch_data((phys, b), value, packed, encoder)
+                blocks[b] = data
+            start = offsets[idx] - offsets[starts[b]]
+            return buffer(data, start, offsets[idx + 1] - offsets[idx])
+        return count, member
+
+    def _batch_data(self, key, value, packed, encoder=None):
+        # Unpack `packed`, a region of `value`, consulting the batch cache
+        # using `key`. Sub-blocks of blocked batches are cached as (phys,
+        # block) tuples; they are invalidated by the `value` token check.
+        cache = self.batch_cache
+        data = None if cache is None else cache.get(key, value)
+        if data is None:
+            if encoder:
+                data = encoder.unpack(packed)
+            else:
+                data = self._decompress(packed)
+            if cache is not None:
+                cache.put(key, data, len(data), value)
+        return data
+
+    def _invalidate(self, phys):
+        if self.batch_cache is not None:
+            self.batch_cache.pop(phys)
 
     def _decompress(self, s):
         encoder = self.store.get_encoder(s[0])
         return encoder.unpack(buffer(s, 1))
 
     def _index_keys(self, key, obj):
+        # Return the sorted list of index entry keys for a record. Sorting
+        # allows old and new keys to be compared with _sorted_diff().
         idx_keys = []
         for idx in self.indices.itervalues():
             lst = idx.func(obj)
+            if lst is SKIP:
+                continue
             for idx_key in lst if type(lst) is list else [lst]:
                 idx_keys.append(encode_keys(idx.prefix, [idx_key, key]))
+        idx_keys.sort()
         return idx_keys
 
+    def _check_unique(self, txn, index_keys, key, old_key=None):
+        # Raise ValueError if an entry in `index_keys` for a unique index
+        # already refers to a record other than `key` or `old_key`. Each entry
+        # ends with the encoded record key, so stripping it gives the probe.
+        enc = encode_keys('', key)
+        owners = (enc, old_key and encode_keys('', old_key))
+        for idx in self._unique:
+            for index_key in index_keys:
+                if not index_key.startswith(idx.prefix):
+                    continue
+                probe = index_key[:-len(enc)]
+                if self.bloom and probe not in self.bloom:
+                    continue
+                found = idx._probe(txn, probe)
+                if found is not None and found[len(probe):] not in owners:
+                    tup, other = idx._decode(found)
+                    raise ValueError('unique index %r: %r is already used '
+                                     'by key %r' % (idx.info['name'], tup,
+                                                    other))
+
+    def _put_index_keys(self, txn, index_keys, obj, added=None):
+        # Write `index_keys` for the record value `obj`, storing projections
+        # for any covered indices. If `added` is not None, only entries it
+        # contains are written, along with covered entries whose projection
+        # may have changed.
+        covers = [(idx.prefix, idx._cover(obj))
+                  for idx in self.indices.itervalues()
+                  if idx.covered is not None]
+        if not covers:
+            for index_key in index_keys if added is None else added:
+                txn.put(index_key, '')
+            return
+
+        added = added if added is None else set(added)
+        for index_key in index_keys:
+            value = ''
+            for prefix, cover in covers:
+                if index_key.startswith(prefix):
+                    value = cover
+                    break
+            if value or added is None or index_key in added:
+                txn.put(index_key, value)
+
     def items(self, key=None, lo=None, hi=None, reverse=False, max=None,
             include=False, txn=None, rec=None):
         """Yield all `(key tuple, value)` tuples in key order. If `rec` is
         ``True``, :py:class:`Record` instances are yielded instead of record
-        values."""
+        values. Their values are decoded only when :py:attr:`Record.data` is
+        first accessed, so records skipped after inspecting their keys cost
+        neither decoding nor index functions."""
         txn_id = getattr(txn or self.engine, 'txn_id', None)
         it = self._iter(txn, key, lo, hi, reverse, max, include, None)
         for batch, key, data in it:
-            obj = self.encoder.unpack(data)
             if rec:
-                obj = Record(self, obj, key, batch, txn_id,
-                             self._index_keys(key, obj))
+                obj = Record(self, None, key, batch, txn_id, None, data)
+            else:
+                obj = self.encoder.unpack(data)
             yield key, obj
 
     def keys(self, key=None, lo=None, hi=None, reverse=None, max=None,
             include=False, txn=None, rec=None):
-        """Yield key tuples in key order."""
-        return itertools.imap(ITEMGETTER_0,
-            self.items(key, lo, hi, reverse, max, include, txn, rec))
+        """Yield key tuples in key order. Record values are never decompressed
+        or decoded, and batch members are listed using only their physical
+        key."""
+        it = self._iter(txn, key, lo, hi, reverse, max, include, None, True)
+        return itertools.imap(ITEMGETTER_1, it)
 
     def values(self, key=None, lo=None, hi=None, reverse=None, max=None,
             include=False, txn=None, rec=None):
@@ -871,9 +2275,95 @@ class Collection(object):
         return itertools.imap(ITEMGETTER_1,
             self.items(key, lo, hi, reverse, max, include, txn, rec))
 
-    def gets(self, keys, default=None, rec=False, txn=None):
-        """Yield `get(k)` for each `k` in the iterable `keys`."""
-        return (self.get(x, default, rec, txn) for k in keys)
+    def gets(self, keys, default=None, rec=False, txn=None, key_order=False):
+        """Yield `get(k)` for each `k` in the iterable `keys`, in input order.
+        If `key_order` is ``True``, instead yield `(key, get(key))` tuples in
+        key order.
+
+        Rather than looking up each key separately, all keys are encoded and
+        sorted, then found by walking forward with a single engine iterator,
+        which is only reopened to skip large gaps between keys. Each batch is
+        decoded once for all its requested members. Every key is looked up
+        before the first value is yielded in input order.
+
+        As for :py:meth:`get`, `default` is yielded for missing keys, or if
+        `rec` is ``True``, a new :py:class:`Record` wrapping it for each one.
+        """
+        keys = [tuplize(k) for k in keys]
+        encoded = encode_keys_many(self.prefix, keys)
+        order = sorted(xrange(len(keys)), key=encoded.__getitem__)
+        txn_id = getattr(txn or self.engine, 'txn_id', None)
+
+        def lookup():
+            for i, batch, data in self._multi_get(txn, encoded, order):
+                if data is None:
+                    if rec and default is not None:
+                        yield i, Record(self, default)
+                    else:
+                        yield i, default
+                    continue
+                if rec:
+                    obj = Record(self, None, keys[i], batch, txn_id, None,
+                                 data)
+                else:
+                    obj = self.encoder.unpack(data)
+                yield i, obj
+
+        if key_order:
+            return ((keys[i], obj) for i, obj in lookup())
+        out = [None] * len(keys)
+        for i, obj in lookup():
+            out[i] = obj
+        return iter(out)
+
+    def _multi_get(self, txn, encoded, order):
+        # Yield `(i, batch, data)` for each physical key `encoded[i]`, visited
+        # in the sorted order `order`, where `data` is the record's encoded
+        # value or ``None`` if it is missing.
+        if not order:
+            return
+        prefix = self.prefix
+        def open_(target):
+            start = target[0] if target else encoded[order[0]]
+            return (txn or self.engine).iter(start, False)
+        cursor = _QueryCursor(open_, False)
+        cur = members = None
+        for i in order:
+            phys = encoded[i]
+            if self.bloom and phys not in self.bloom:
+                yield i, False, None
+                continue
+            cursor.seek((phys,))
+            if cursor.head is not cur:
+                # Physical record changed; split its key, and recover the
+                # members of a "pure keys" batch from its values.
+                cur = cursor.head
+                members = cur and split_keys(prefix, cur[0])
+                member = None
+                if members and len(members) == 2 and self.key_func \
+                        and decode_int_s(cur[1]) > 2:
+                    count, member = self._batch_reader(cur[0], cur[1])
+                    members = _PureMembers(self, count, member)
+            if not members:
+                yield i, False, None
+                continue
+            # Members are listed in descending order.
+            enc = phys[len(prefix):]
+            lo, hi = 0, len(members)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if members[mid] > enc:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == len(members) or members[lo] != enc:
+                yield i, False, None
+            elif len(members) == 1:
+                yield i, False, self._decompress(cur[1])
+            else:
+                if member is None:
+                    member = self._batch_reader(cur[0], cur[1])[1]
+                yield i, True, member(len(members) - 1 - lo)
 
     def find(self, key=None, lo=None, hi=None, reverse=None, include=False,
              txn=None, rec=None, default=None):
@@ -892,8 +2382,13 @@ class Collection(object):
         a :py:class:`Record` instance for use when later re-saving the record,
         otherwise only the record's value is returned."""
         key = tuplize(key)
-        it = self._iter(txn, None, key, key, False, None, True, None)
-        tup = next(it, None)
+        if self.bloom and encode_keys(self.prefix, key) not in self.bloom:
+            tup = None
+        elif self.record_cache is not None:
+            tup = self._cache_get(txn, key)
+        else:
+            it = self._iter(txn, None, key, key, False, None, True, None)
+            tup = next(it, None)
         if tup:
             txn_id = getattr(txn or self.engine, 'txn_id', None)
             obj = self.encoder.unpack(tup[2])
@@ -906,16 +2401,38 @@ class Collection(object):
             return Record(self, default) if rec else default
         return
 
+    def _cache_get(self, txn, key):
+        # Return the record cache entry `(batch, key, data)` for `key`, or
+        # ``None`` if the record does not exist. The entry is validated against
+        # the physical record found by a single seek, and refilled using
+        # _iter() if that record changed since it was cached.
+        cache = self.record_cache
+        it = (txn or self.engine).iter(encode_keys(self.prefix, key), False)
+        item = next(it, None)
+        token = item and _cache_token(*item)
+        entry = cache.get(key, token)
+        if entry is None:
+            it = self._iter(txn, None, key, key, False, None, True, None)
+            tup = next(it, None)
+            if not (tup and token):
+                return
+            entry = tup[0], key, str(tup[2])
+            cache.put(key, entry, len(entry[2]), token)
+        return entry
+
     def batch(self, lo=None, hi=None, max_recs=None, max_bytes=None,
               preserve=True, packer=None, txn=None, max_phys=None,
-              grouper=None):
+              grouper=None, block_size=None, processes=None, max_time=None):
         """
         Search the key range *lo..hi* for individual records, combining them
         into a batches.
 
         Returns `(found, made, last_key)` indicating the number of records
-        combined, the number of batches produced, and the last key visited
-        before `max_phys` was exceeded.
+        combined, the number of batches produced, and the key to resume from
+        after `max_phys` or `max_time` was exceeded, or ``None`` if the entire
+        range was visited. Records following the last complete batch are left
+        for the next call, so batch boundaries do not depend on how the range
+        was divided.
 
         Batch size is controlled via `max_recs` and `max_bytes`; at least one
         must not be ``None``. Larger sizes may cause pathological behaviour in
@@ -939,11 +2456,13 @@ class Collection(object):
             `max_bytes`:
                 Maximum size in bytes of the batch record's value after
                 compression, or ``None`` for no maximum size. When not
-                ``None``, values are recompressed after each member is
-                appended, in order to test if `maxbytes` has been reached. This
-                is inefficient, but provides the best guarantee of final record
-                size. Single records are skipped if they exceed this size when
-                compressed individually.
+                ``None``, the compressed size is estimated as members are
+                appended, using the compression ratio observed when the batch
+                was last compressed. The batch is only recompressed once the
+                estimate nears `max_bytes`, and every batch is measured exactly
+                and split again if necessary before being written. Single
+                records are skipped if they exceed this size when compressed
+                individually.
 
             `preserve`:
                 If ``True``, then existing batch records in the database are
@@ -966,10 +2485,15 @@ class Collection(object):
             `max_phys`:
                 Maximum number of physical keys to visit in any particular
                 call. A collection may be incrementally batched by repeatedly
-                invoking :py:meth:`Collection.batch` with `max` set, and `lo`
-                set to `last_key` of the previous run, until `found` returns
-                ``0``. This allows batching to complete over several
-                transactions without blocking other users.
+                invoking :py:meth:`Collection.batch` with `max_phys` set, and
+                `lo` set to `last_key` of the previous run, until `last_key`
+                is ``None``. This allows batching to complete over several
+                transactions without blocking other users. See
+                :py:class:`BatchScheduler`.
+
+            `max_time`:
+                Like `max_phys`, but limits the wall-clock seconds spent
+                visiting physical keys.
 
             `grouper`:
                 Specifies a grouping function used to decide when to avoid
@@ -977,75 +2501,297 @@ class Collection(object):
                 record's value. A new batch is triggered each time the
                 function's return value changes.
 
+            `block_size`:
+                If not ``None``, batches are written in a seekable format,
+                where members are split into sub-blocks of approximately this
+                many uncompressed bytes that are compressed independently.
+                Reading a single member then only decompresses the sub-block
+                containing it, at some cost to compression ratio. Sizes around
+                4-16KiB usually compress almost as well as a single block.
+
+            `processes`:
+                If not ``None``, compression is spread across a
+                :py:class:`multiprocessing.Pool` of this many worker processes.
+                The calling thread reads runs of records and applies deletes,
+                while workers divide runs into batches and compress them.
+                Batches are written by the calling thread in key order, so
+                `max_phys` and transactions behave as usual. Requires a
+                platform where worker processes are forked, since the
+                collection and packer are inherited rather than pickled.
+
         """
         assert max_bytes or max_recs, 'max_bytes and/or max_recs is required.'
         txn = txn or self.engine
         packer = packer or self.packer
-        it = self._iter(txn, None, lo, hi, False, None, True, max_phys)
+        # Workers cannot update metadata, so register the packer first.
+        self.store.add_encoder(packer)
+        budget = None
+        if max_phys is not None or max_time is not None:
+            budget = _Budget(max_phys, max_time)
+        # Existing batches are skipped, so avoid decompressing them.
+        it = self._iter(txn, None, lo, hi, False, None, True, budget,
+                        batch_values=not preserve)
+        resume = [None]
+        runs = self._batch_runs(txn, it, max_recs, preserve, grouper, budget,
+                                resume)
+        found = made = 0
+        if not processes:
+            for run in runs:
+                batches = self._pack_run(run, packer, max_bytes, block_size)
+                self._write_batches(txn, batches)
+                found += len(run)
+                made += len(batches)
+            return found, made, self._last_key(budget, resume, lo)
+
+        pool = multiprocessing.Pool(processes, _batch_worker_init,
+                                    (self, packer, max_bytes, block_size))
+        try:
+            # Results are written in submission order, i.e. key order, while
+            # at most 2 runs per worker are in flight.
+            pending = collections.deque()
+            for run in runs:
+                found += len(run)
+                pending.append(pool.apply_async(_batch_worker, (run,)))
+                while pending and (len(pending) > (2 * processes) or
+                                   pending[0].ready()):
+                    batches = pending.popleft().get()
+                    self._write_batches(txn, batches)
+                    made += len(batches)
+            while pending:
+                batches = pending.popleft().get()
+                self._write_batches(txn, batches)
+                made += len(batches)
+            pool.close()
+        finally:
+            pool.terminate()
+        return found, made, self._last_key(budget, resume, lo)
+
+    def _last_key(self, budget, resume, lo):
+        if budget and budget.spent:
+            if resume[0] is not None:
+                return resume[0]
+            return () if lo is None else tuplize(lo)
+
+    def _batch_runs(self, txn, it, max_recs, preserve, grouper, budget,
+                    resume):
+        # Yield lists of `(key, data)` for contiguous records that may be
+        # combined, deleting their physical keys. Runs end at `max_recs`,
+        # existing batches when `preserve=True`, and `grouper` changes;
+        # _pack_run() further divides them according to `max_bytes`.
+        #
+        # resume[0] is set to the key a later call should resume from. If
+        # `budget` ended iteration, the final run is probably incomplete, so
+        # it is left for the next call, unless it is all this call found.
         groupval = None
+        first = None
         items = []
-
         for batch, key, data in it:
+            if first is None:
+                first = key
+            resume[0] = key
             if preserve and batch:
-                self._write_batch(txn, items, packer)
-            else:
-                txn.delete(encode_keys(self.prefix, key))
-                items.append((key, data))
-                if max_bytes:
-                    _, encoded = self._prepare_batch(items, packer)
-                    if len(encoded) > max_bytes:
-                        items.pop()
-                        self._write_batch(txn, items, packer)
-                        items.append((key, data))
-                done = max_recs and len(items) == max_recs
-                if (not done) and grouper:
-                    val = grouper(self.encoder.unpack(data))
-                    done = val != groupval
-                    groupval = val
-                if done:
-                    self._write_batch(txn, items, packer)
-        self._write_batch(txn, items, packer)
-
-    def _write_batch(self, txn, items, packer):
+                if items:
+                    yield self._claim_run(txn, items)
+                    items = []
+                continue
+            items.append((key, str(data)))
+            done = max_recs and len(items) == max_recs
+            if (not done) and grouper:
+                val = grouper(self.encoder.unpack(data))
+                done = val != groupval
+                groupval = val
+            if done:
+                yield self._claim_run(txn, items)
+                items = []
         if items:
-            phys, data = self._prepare_batch(items, packer)
+            if budget and budget.spent and items[0][0] != first:
+                resume[0] = items[0][0]
+            else:
+                yield self._claim_run(txn, items)
+
+    def _claim_run(self, txn, items):
+        for key, _ in items:
+            phys = encode_keys(self.prefix, key)
+            txn.delete(phys)
+            self._invalidate(phys)
+            if self.record_cache is not None:
+                self.record_cache.pop(key)
+        return items
+
+    def _pack_run(self, items, packer, max_bytes, block_size):
+        """Return `(phys, data)` for each batch formed by dividing `items`
+        into batches no larger than `max_bytes`."""
+        out = []
+        sizer = max_bytes and _BatchSizer(self, packer, max_bytes,
+                                          block_size)
+        batch = []
+        for item in items:
+            batch.append(item)
+            while sizer and not sizer.fits(batch):
+                n, prepared = sizer.split(batch)
+                out.append(self._finish_batch(batch[:n], packer, block_size,
+                                              prepared))
+                del batch[:n]
+        while batch:
+            n = len(batch)
+            prepared = sizer and sizer.measure(batch)
+            if sizer and not prepared:
+                n, prepared = sizer.split(batch)
+            out.append(self._finish_batch(batch[:n], packer, block_size,
+                                          prepared))
+            del batch[:n]
+        return out
+
+    def _finish_batch(self, items, packer, block_size, prepared=None):
+        phys, data = prepared or self._prepare_batch(items, packer, block_size)
+        if self.pure_keys and len(items) > 2 and self._derived(items):
+            phys = encode_keys(self.prefix, [items[-1][0], items[0][0]])
+        return phys, data
+
+    def _write_batches(self, txn, batches):
+        for phys, data in batches:
             txn.put(phys, data)
-            del items[:]
-
-    def _prepare_batch(self, items, packer):
-        packer_prefix = self.store._encoder_prefix.get(packer)
-        if not packer_prefix:
-            packer_prefix = self.store.add_encoder(packer)
+            self._invalidate(phys)
+
+    def _derived(self, items):
+        """Return ``True`` if every key in `items` can be recovered by applying
+        `key_func` to its value."""
+        unpack = self.encoder.unpack
+        return all(key == tuplize(self.key_func(unpack(data)))
+                   for key, data in items)
+
+    def _pack(self, packer, s):
+        # Return `s` compressed by `packer`, prefixed by the encoder prefix of
+        # the packer used, which is chosen per value by an AdaptivePacker.
+        packed = None
+        if type(packer) is AdaptivePacker:
+            packer, packed = packer.choose(s)
+        if packed is None:
+            packed = packer.pack(s)
+        return self._packer_prefix(packer) + packed
+
+    def _packer_prefix(self, packer):
+        return self.store._encoder_prefix.get(packer) or \
+            self.store.add_encoder(packer)
+
+    def _prepare_batch(self, items, packer, block_size=None):
         phys = encode_keys(self.prefix, [key for key, _ in reversed(items)])
         io = cStringIO.StringIO()
 
         if len(items) == 1:
-            io.write(packer_prefix + packer.pack(items[0][1]))
+            io.write(self._pack(packer, items[0][1]))
         else:
             io.write(encode_int(len(items)))
+            offsets = [0]
             for _, data in items:
                 io.write(encode_int(len(data)))
-            io.write(packer_prefix)
+                offsets.append(offsets[-1] + len(data))
             concat = ''.join(data for _, data in items)
-            io.write(packer.pack(concat))
+            starts = block_size and _block_starts(offsets, block_size)
+            if starts and len(starts) > 1:
+                if type(packer) is AdaptivePacker:
+                    packer = packer.choose(concat)[0]
+                bounds = itertools.izip(starts, starts[1:] + [len(items)])
+                blocks = [packer.pack(concat[offsets[s]:offsets[e]])
+                          for s, e in bounds]
+                io.write('\x00' + encode_int(block_size) +
+                         self._packer_prefix(packer))
+                for block in blocks:
+                    io.write(encode_int(len(block)))
+                for block in blocks:
+                    io.write(block)
+            else:
+                io.write(self._pack(packer, concat))
         return phys, io.getvalue()
 
-    def _split_batch(self, rec, txn):
-        assert rec.key and rec.batch
-        assert False
-        it = _iter(txn, rec.key, None, None, None, None, None)
-        keys, data = next(it, (None, None))
-        assert len(keys) > 1 and rec.key in keys, \
-            'Physical key missing: %r' % (rec.key,)
-
-        assert 0
-        objs = self.encoder.loads_many(self._decompress(data))
-        for i, obj in enumerate(objs):
-            if keys[-(1 + i)] != rec.key:
-                self.put(Record(self, obj), txn, key=keys[-(1 + i)])
-        (txn or self.engine).delete(phys)
-        rec.key = None
-        rec.batch = False
+    def _batch_packer(self, value):
+        # Return `(packer, block_size)` used to produce a batch record value.
+        _, dstart = decode_offsets(value)
+        if value[dstart] != '\x00':
+            return self.store.get_encoder(value[dstart]), None
+        io = cStringIO.StringIO(value)
+        io.seek(dstart + 1)
+        getc = functools.partial(io.read, 1)
+        block_size = decode_int(getc, io.read)
+        return self.store.get_encoder(getc()), block_size
+
+    def _covering_batch(self, txn, key):
+        """Return `(phys, value, items, pos, found)` for the batch whose key
+        range covers `key`, or ``None`` if no batch does. `items` lists the
+        batch's `(key, data)` members in ascending order, and `pos` is the
+        position of `key` within it, or where it would be inserted if `found`
+        is ``False``."""
+        lo = encode_keys('', key)
+        phys, value = next(txn.iter(self.prefix + lo, False), (None, None))
+        members = phys and split_keys(self.prefix, phys)
+        if not members or len(members) < 2 or members[-1] > lo:
+            return
+
+        count, member = self._batch_reader(phys, value)
+        if count > len(members):
+            members = _PureMembers(self, count, member)
+        encoded = [members[pos] for pos in xrange(count - 1, -1, -1)]
+        pos = bisect.bisect_left(encoded, lo)
+        found = pos < count and encoded[pos] == lo
+        keys = decode_keys_many('', encoded)
+        items = [(k[0], str(member(i))) for i, k in enumerate(keys)]
+        return phys, value, items, pos, found
+
+    def _rewrite_batch(self, txn, phys, value, runs):
+        """Replace the batch record `phys` having value `value` with a batch
+        for each list of `(key, data)` items in `runs`, using the batch's
+        original packer and layout. Runs of a single item are saved as
+        regular records."""
+        packer, block_size = self._batch_packer(value)
+        batches = []
+        for run in runs:
+            if len(run) > 1:
+                batches.extend(self._pack_run(run, packer, None, block_size))
+            elif run:
+                key, data = run[0]
+                batches.append((encode_keys(self.prefix, key),
+                                self._pack(packer, data)))
+        if phys not in [p for p, _ in batches]:
+            txn.delete(phys)
+            self._invalidate(phys)
+        self._write_batches(txn, batches)
+
+    def _split_batch(self, rec, txn, data=None, max_bytes=None):
+        """Rewrite the batch containing `rec.key`, either removing the member,
+        or if `data` is not ``None``, replacing its encoded value with `data`.
+        The batch is repacked using its original packer and layout. Returns
+        ``True`` if `data` was stored in the batch, or ``False`` if it was
+        removed. When the rewritten batch would exceed `max_bytes`, the batch
+        is instead split into two around the member, so the caller may save
+        it as a regular record without overlapping either."""
+        found = self._covering_batch(txn, rec.key)
+        assert found and found[4], 'Physical key missing: %r' % (rec.key,)
+        phys, value, items, idx, _ = found
+
+        if data is not None:
+            packer, block_size = self._batch_packer(value)
+            items[idx] = (rec.key, data)
+            batches = self._pack_run(items, packer, None, block_size)
+            if max_bytes is None or len(batches[0][1]) <= max_bytes:
+                if batches[0][0] != phys:
+                    txn.delete(phys)
+                    self._invalidate(phys)
+                self._write_batches(txn, batches)
+                return True
+            runs = [items[:idx], items[idx + 1:]]
+        else:
+            runs = [items[:idx] + items[idx + 1:]]
+        self._rewrite_batch(txn, phys, value, runs)
+        return False
+
+    def _split_around(self, txn, found):
+        """Given :py:meth:`_covering_batch` output for a key the batch does
+        not contain, split the batch into two either side of the key, so a
+        regular record may be saved for it without hiding the batch's
+        members."""
+        if found and not found[4]:
+            phys, value, items, pos, _ = found
+            self._rewrite_batch(txn, phys, value, [items[:pos], items[pos:]])
 
     def _reassign_key(self, rec, txn):
         if rec.key and not self.derived_keys:
@@ -1059,16 +2805,105 @@ class Collection(object):
         `eat` is ``True``, returns the number of items processed, otherwise
         returns an iterator that lazily calls :py:meth:`put` and yields its
         return values."""
-        return _eat(eat, (self.put(rec, txn, packer) for rec in recs), True)
+        it = self._puts(((None, rec) for rec in recs), txn, packer)
+        return _eat(eat, it, True)
 
     def putitems(self, it, txn=None, packer=None, eat=True):
         """Invoke :py:meth:`put(y, key=x)` for each (x, y) in the iterable
         `it`. If `eat` is ``True``, returns the number of items processed,
         otherwise returns an iterator that lazily calls :py:meth:`put` and
         yields its return values."""
-        return _eat(eat, (self.put(y, txn, packer, x) for x, y in it), True)
-
-    def put(self, rec, txn=None, packer=None, key=None, virgin=False):
+        return _eat(eat, self._puts(it, txn, packer), True)
+
+    def _puts(self, it, txn, packer):
+        # Keys are encoded a chunk at a time, so the per-call cost of
+        # encode_keys_many() is paid once per chunk. Keys from txn_key_func,
+        # such as counter keys, are only assigned as each record is saved, so
+        # a caller that stops early never consumes them.
+        for chunk in _chunks(iter(it)):
+            recs = []
+            keys = []
+            for key, rec in chunk:
+                if type(rec) is not Record:
+                    rec = Record(self, rec)
+                recs.append(rec)
+                if key is not None:
+                    key = tuplize(key)
+                elif not self.txn_key_func or \
+                        (rec.key and not self.derived_keys):
+                    key = self._reassign_key(rec, txn)
+                keys.append(key)
+            known = [key for key in keys if key is not None]
+            physs = iter(encode_keys_many(self.prefix, known))
+            for rec, key in itertools.izip(recs, keys):
+                if key is None:
+                    key = self._reassign_key(rec, txn)
+                    phys = encode_keys(self.prefix, key)
+                else:
+                    phys = next(physs)
+                yield self._put(rec, txn, packer, key, phys, False)
+
+    def putbatch(self, recs, txn=None, packer=None, max_recs=None,
+                 max_bytes=None, block_size=None):
+        """Save the values in the iterable `recs` as new records, writing them
+        directly as batches rather than via :py:meth:`put` followed by
+        :py:meth:`batch`. Keys are assigned as usual, and index entries are
+        written. Returns the list of assigned keys, in input order.
+
+        Records are sorted by key, then divided into batches as described for
+        `max_recs`, `max_bytes`, `packer` and `block_size` in
+        :py:meth:`batch`. Since batches cannot overlap existing records, a
+        :py:exc:`ValueError` is raised if any batch's key range contains a
+        record already in the collection, or if keys repeat; records written
+        before the error remain in `txn`. Collections with time-based or
+        counter keys, such as logs, never trigger this.
+        """
+        assert max_bytes or max_recs, 'max_bytes and/or max_recs is required.'
+        txn = txn or self.engine
+        packer = packer or self.packer
+        self.store.add_encoder(packer)
+        keys = []
+        items = []
+        for rec in recs:
+            if type(rec) is not Record:
+                rec = Record(self, rec)
+            key = self._reassign_key(rec, txn)
+            keys.append(key)
+            items.append((encode_keys('', key), key, rec.data))
+        items.sort(key=ITEMGETTER_0)
+
+        step = max_recs or len(items)
+        for i in xrange(0, len(items), step):
+            run = items[i:i+step]
+            for j in xrange(1, len(run)):
+                if run[j - 1][0] == run[j][0]:
+                    raise ValueError('duplicate key: %r' % (run[j][1],))
+            self._check_vacant(txn, run[0][0], run[-1][0])
+            for _, key, obj in run:
+                index_keys = self._index_keys(key, obj)
+                if self._unique:
+                    self._check_unique(txn, index_keys, key)
+                self._put_index_keys(txn, index_keys, obj)
+                if self.bloom:
+                    self.bloom._add_record(txn, encode_keys(self.prefix, key),
+                                           key, index_keys)
+            run = [(key, self.encoder.pack(obj)) for _, key, obj in run]
+            self._write_batches(txn,
+                self._pack_run(run, packer, max_bytes, block_size))
+        return keys
+
+    def _check_vacant(self, txn, lo, hi):
+        # Raise ValueError if any record exists within encoded keys lo..hi.
+        # Any such record is stored in the first physical key at or after lo,
+        # since batches never overlap.
+        tup = next(txn.iter(self.prefix + lo, False), None)
+        members = tup and split_keys(self.prefix, tup[0])
+        if members and members[-1] <= hi:
+            raise ValueError('putbatch() range overlaps existing record %r'
+                             % (decode_key('', members[-1]),))
+
+    def put(self, rec, txn=None, packer=None, key=None, virgin=False,
+            max_bytes=None):
         """Create or overwrite a record.
 
             `rec`:
@@ -1095,7 +2930,9 @@ class Collection(object):
                 If ``True``, skip checks for any old record assigned the same
                 key. Automatically enabled when a collection has no indices, or
                 when `virgin_keys=` is passed to :py:class:`Collection`'s
-                constructor.
+                constructor. A single seek is still made to find any batch
+                whose key range covers the key, which is rewritten to exclude
+                or replace it.
 
                 While this significantly improves performance, enabling it for
                 a collection with indices and in the presence of old records
@@ -1103,38 +2940,92 @@ class Collection(object):
                 :py:meth:`Index.iteritems` will issue a warning and discard
                 obsolete keys when this is detected, however other index
                 methods will not.
+
+            `max_bytes`:
+                When `rec` was loaded from a batch and its key is unchanged,
+                the batch is rewritten with the new value in place, using the
+                batch's original packer. If not ``None`` and the rewritten
+                batch would exceed this size, the record is instead removed
+                from the batch and saved individually. `packer` is only used
+                for records saved individually.
         """
         if type(rec) is not Record:
             rec = Record(self, rec)
         obj_key = key or self._reassign_key(rec, txn)
+        return self._put(rec, txn, packer, obj_key,
+                         encode_keys(self.prefix, obj_key), virgin, max_bytes)
+
+    def _put(self, rec, txn, packer, obj_key, phys, virgin, max_bytes=None):
         index_keys = self._index_keys(obj_key, rec.data)
         txn = txn or self.engine
-
-        if rec.coll is self and rec.key:
-            if rec.batch:
-                # Old key was part of a batch, explode the batch.
-                self._split_batch(rec, txn)
-            elif rec.key != obj_key:
+        if self._unique:
+            self._check_unique(txn, index_keys, obj_key,
+                               rec.key if rec.coll is self else None)
+
+        data = self.encoder.pack(rec.data)
+        batch = False
+        added = None
+        old = rec if rec.coll is self and rec.key else None
+        unchecked = virgin or self.virgin_keys or not self.indices
+        covering = None
+        located = self._unbatched
+        if old is None and unchecked and not located:
+            # No old index entries need removing, but the key may still be a
+            # batch member, or fall inside a batch's key range.
+            covering = self._covering_batch(txn, obj_key)
+            located = True
+            if covering and covering[4]:
+                old = self.get(obj_key, rec=True, txn=txn)
+        elif old is None and not unchecked:
+            # Old key might already exist, so replace it, unless the filter
+            # proves it does not.
+            if not (self.bloom and phys not in self.bloom):
+                old = self.get(obj_key, rec=True, txn=txn)
+        if old is not None:
+            if old.batch:
+                # Old key was part of a batch, so rewrite just that batch,
+                # with the new value if the key is unchanged.
+                batch = self._split_batch(old, txn,
+                    data if old.key == obj_key else None, max_bytes)
+            elif old.key != obj_key:
                 # New version has changed key, delete old.
-                txn.delete(encode_keys(self.prefix, rec.key))
-            if index_keys != rec.index_keys:
-                for index_key in rec.index_keys or ():
-                    txn.delete(index_key)
-        elif self.indices and not (virgin or self.virgin_keys):
-            # TODO: delete() may be unnecessary when no indices are defined
-            # Old key might already exist, so delete it.
-            self.delete(obj_key)
-
-        packer = packer or self.packer
-        packer_prefix = self.store._encoder_prefix.get(packer)
-        if not packer_prefix:
-            packer_prefix = self.store.add_encoder(packer)
-        txn.put(encode_keys(self.prefix, obj_key),
-                packer_prefix + packer.pack(self.encoder.pack(rec.data)))
-        for index_key in index_keys:
-            txn.put(index_key, '')
+                old_phys = encode_keys(self.prefix, old.key)
+                txn.delete(old_phys)
+                self._invalidate(old_phys)
+            # Only touch index entries that changed.
+            removed, added = _sorted_diff(old.index_keys or [], index_keys)
+            for index_key in removed:
+                txn.delete(index_key)
+        if not batch and (old is None or old.key != obj_key):
+            # Never save a regular record inside a batch's key range, since
+            # it would hide the batch's members.
+            if not located:
+                covering = self._covering_batch(txn, obj_key)
+            self._split_around(txn, covering)
+
+        if not batch:
+            packer = packer or self.packer
+            packed = self._pack(packer, data)
+            txn.put(phys, packed)
+            self._invalidate(phys)
+        cache = self.record_cache
+        if cache is not None:
+            if rec.coll is self and rec.key and rec.key != obj_key:
+                cache.pop(rec.key)
+            if batch:
+                cache.pop(obj_key)
+            else:
+                # Write-through; readers in other transactions see a
+                # different physical record, so will not use the entry.
+                cache.put(obj_key, (False, obj_key, data), len(data),
+                          _cache_token(phys, packed))
+        self._put_index_keys(txn, index_keys, rec.data, added)
+        if self.bloom:
+            self.bloom._add_record(txn, phys, obj_key,
+                                   index_keys if added is None else added)
         rec.coll = self
         rec.key = obj_key
+        rec.batch = batch
         rec.index_keys = index_keys
         return rec
 
@@ -1169,15 +3060,20 @@ class Collection(object):
         if isinstance(obj, Record):
             rec = obj
         else:
-            rec = self.get(obj, rec=True)
+            rec = self.get(obj, rec=True, txn=txn)
         if rec and rec.key: # todo rec.key must be set
+            txn = txn or self.engine
             if rec.batch:
+                # Rewrite the batch without the member.
                 self._split_batch(rec, txn)
             else:
-                delete = (txn or self.engine).delete
-                delete(encode_keys(self.prefix, rec.key))
-                for index_key in rec.index_keys or ():
-                    delete(index_key)
+                phys = encode_keys(self.prefix, rec.key)
+                txn.delete(phys)
+                self._invalidate(phys)
+            for index_key in rec.index_keys or ():
+                txn.delete(index_key)
+            if self.record_cache is not None:
+                self.record_cache.pop(rec.key)
             rec.key = None
             rec.batch = False
             rec.index_keys = None
@@ -1212,6 +3108,210 @@ class Collection(object):
         assert self.derived_keys
         return self.delete(self.key_func(val), txn)
 
+class BatchScheduler(object):
+    """Incrementally batch a :py:class:`Collection` in small slices, each
+    bounded by wall-clock time and/or physical keys visited, allowing
+    compaction to run continuously alongside live traffic without long write
+    transactions. Existing batches are skipped over. The position reached is
+    saved in :py:class:`Store` metadata as part of each slice's transaction,
+    so work resumes where it left off after a restart.
+
+        `coll`:
+            :py:class:`Collection` to batch.
+
+        `max_phys`, `max_time`:
+            Maximum physical keys visited and/or seconds spent by each call to
+            :py:meth:`step`. At least one is required.
+
+        `lo`, `hi`:
+            Key range to batch; defaults to the entire collection.
+
+        `name`:
+            Name progress is saved under, defaults to
+            ``"batch:<collection name>"``.
+
+        `kwargs`:
+            Remaining arguments are passed to :py:meth:`Collection.batch`, e.g.
+            `max_recs`, `max_bytes`, `packer` and `grouper`.
+
+    ::
+
+        sched = centidb.BatchScheduler(coll, max_time=0.05, max_recs=64)
+        while True:
+            txn = engine.begin(write=True)
+            done = sched.step(txn)
+            txn.txn.commit()
+            if done:
+                time.sleep(60)
+    """
+    def __init__(self, coll, max_phys=None, max_time=None, lo=None, hi=None,
+                 name=None, **kwargs):
+        assert max_phys or max_time, 'max_phys and/or max_time is required.'
+        assert kwargs.get('preserve', True), 'preserve=False is unsupported.'
+        self.coll = coll
+        self.max_phys = max_phys
+        self.max_time = max_time
+        self.lo = lo
+        self.hi = hi
+        self.name = name or ('batch:%(name)s' % coll.info)
+        self.kwargs = kwargs
+        #: Total records combined by :py:meth:`step`.
+        self.found = 0
+        #: Total batches produced by :py:meth:`step`.
+        self.made = 0
+
+    @property
+    def cursor(self):
+        """Key the next :py:meth:`step` will start from, or ``None`` if it
+        will start a new pass."""
+        tup = self.coll.store._meta_coll.get(self.name)
+        return tup and tup[1:]
+
+    def step(self, txn=None):
+        """Batch the next slice of the collection using `txn`, saving the
+        resulting position in the same transaction. Return ``True`` if the
+        slice completed a pass over the collection, in which case the next
+        call starts a new pass."""
+        meta = self.coll.store._meta_coll
+        tup = meta.get(self.name, txn=txn)
+        lo = tup[1:] if tup else self.lo
+        found, made, last_key = self.coll.batch(lo=lo, hi=self.hi,
+            max_phys=self.max_phys, max_time=self.max_time, txn=txn,
+            **self.kwargs)
+        self.found += found
+        self.made += made
+        if last_key is None:
+            if tup:
+                meta.delete(self.name, txn=txn)
+            return True
+        meta.put((self.name,) + last_key, txn=txn)
+        return False
+
+class IndexBuilder(object):
+    """Populate an :py:class:`Index` from the records already in its collection
+    in small slices, each bounded by wall-clock time and/or physical keys
+    visited, so an index may be built or rebuilt alongside live traffic without
+    long write transactions. Records written during the build are indexed as
+    usual by :py:meth:`Collection.put`. Progress is saved in :py:class:`Store`
+    metadata as part of each slice's transaction, and until the slice
+    completing the build commits, :py:attr:`Index.building` is ``True`` and
+    queries against the index raise :py:exc:`ValueError`, rather than
+    returning partial results. Every :py:class:`Index` instance for the index
+    observes this, since queries check the saved progress.
+
+    Each slice first deletes any existing entries when the build was started
+    with `clear=True`, then indexes records in key order, writing each slice's
+    new entries in sorted order.
+
+        `index`:
+            :py:class:`Index` to build.
+
+        `max_phys`, `max_time`:
+            Maximum physical keys visited and/or seconds spent by each call to
+            :py:meth:`step`. If both are ``None``, each call completes the
+            build.
+
+    ::
+
+        builder = centidb.IndexBuilder(index, max_time=0.05)
+        builder.start()
+        while True:
+            txn = engine.begin(write=True)
+            done = builder.step(txn)
+            txn.txn.commit()
+            if done:
+                break
+        print '%d records/sec' % builder.rate
+    """
+    def __init__(self, index, max_phys=None, max_time=None):
+        self.index = index
+        self.coll = index.coll
+        self.max_phys = max_phys
+        self.max_time = max_time
+        self.name = index.info['name']
+        #: Total records indexed by :py:meth:`step`.
+        self.records = 0
+        #: Total index entries written by :py:meth:`step`.
+        self.entries = 0
+        #: Total existing index entries deleted by :py:meth:`step`.
+        self.cleared = 0
+        #: Total seconds spent in :py:meth:`step`.
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Records indexed per second spent in :py:meth:`step`."""
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+    def start(self, txn=None, clear=True):
+        """Begin building the index, restarting any build already in progress.
+        If `clear` is ``True``, existing entries are deleted first, dropping
+        any stale entries, otherwise missing entries are only added."""
+        self.coll.store._meta_coll.put((self.name, 'clear' if clear
+                                        else 'scan'), txn=txn)
+
+    def step(self, txn=None):
+        """Perform the next slice of the build using `txn`, saving the
+        resulting position in the same transaction. Return ``True`` if the
+        build is complete."""
+        t0 = time.time()
+        meta = self.coll.store._meta_coll
+        tup = meta.get(self.name, txn=txn)
+        budget = _Budget(self.max_phys, self.max_time)
+        if tup and tup[1] == 'clear':
+            self._clear(txn, budget)
+            if not budget.spent:
+                tup = (self.name, 'scan')
+        if tup and tup[1] == 'scan' and not budget.spent:
+            tup = tup[:2] + self._scan(txn, budget, tup[2:])
+
+        if budget.spent:
+            meta.put(tup, txn=txn)
+        elif tup:
+            meta.delete(self.name, txn=txn)
+        self.elapsed += time.time() - t0
+        return not budget.spent
+
+    def _clear(self, txn, budget):
+        # Delete existing entries. Each slice starts from the first remaining
+        # entry, so no position is saved.
+        prefix = self.index.prefix
+        txn = txn or self.coll.engine
+        it = itertools.takewhile(lambda item: item[0].startswith(prefix),
+                                 txn.iter(prefix, False))
+        keys = [key for key, _ in budget.wrap(it)]
+        for key in keys:
+            txn.delete(key)
+        self.cleared += len(keys)
+
+    def _scan(self, txn, budget, last):
+        # Index records following the key `last`, returning the last key
+        # indexed.
+        coll = self.coll
+        index = self.index
+        entries = []
+        it = coll._iter(txn, None, last or None, None, False, None, False,
+                        budget)
+        for batch, key, data in it:
+            if key == last:
+                continue
+            obj = coll.encoder.unpack(data)
+            cover = index._cover(obj)
+            for index_key in coll._index_keys(key, obj):
+                if index_key.startswith(index.prefix):
+                    entries.append((index_key, cover))
+                    if coll.bloom:
+                        coll.bloom._add_record(txn, None, key, [index_key])
+            self.records += 1
+            last = key
+
+        entries.sort()
+        put = (txn or coll.engine).put
+        for index_key, cover in entries:
+            put(index_key, cover)
+        self.entries += len(entries)
+        return last
+
 class Store(object):
     """Represents access to the underlying storage engine, and manages
     counters.
@@ -1228,12 +3328,18 @@ class Store(object):
             dict((e, encode_int(1+i)) for i, e in enumerate(_ENCODERS)))
         self._prefix_encoder = (
             dict((encode_int(1+i), e) for i, e in enumerate(_ENCODERS)))
+        for packer in _ZLIB_LEVELS:
+            self._encoder_prefix[packer] = self._encoder_prefix[ZLIB_PACKER]
         self._encoder_coll = Collection(self, '\x00encoders', _idx=2,
             encoder=KEY_ENCODER, key_func=lambda tup: tup[0])
         self._info_coll = Collection(self, '\x00collections', _idx=0,
             encoder=KEY_ENCODER, key_func=lambda tup: tup[0])
         self._counter_coll = Collection(self, '\x00counters', _idx=1,
             encoder=KEY_ENCODER, key_func=lambda tup: tup[0])
+        self._dict_coll = Collection(self, '\x00dicts', _idx=3,
+            encoder=KEY_ENCODER, key_func=lambda tup: tup[:2])
+        self._meta_coll = Collection(self, '\x00meta', _idx=4,
+            encoder=KEY_ENCODER, key_func=lambda tup: tup[0])
 
     _INFO_KEYS = ('name', 'idx', 'index_for')
     def _get_info(self, name, idx=None, index_for=None):
@@ -1246,7 +3352,13 @@ class Store(object):
 
     def add_encoder(self, encoder):
         """Register an :py:class:`Encoder` so that :py:class:`Collection` can
-        find it during decompression/unpacking."""
+        find it during decompression/unpacking. For an
+        :py:class:`AdaptivePacker`, each candidate is registered and ``None``
+        is returned."""
+        if type(encoder) is AdaptivePacker:
+            for packer in encoder.packers:
+                self.add_encoder(packer)
+            return
         try:
             return self._encoder_prefix[encoder]
         except KeyError:
@@ -1255,8 +3367,8 @@ class Store(object):
                 idx = self.count('\x00encoder_idx', init=10)
                 assert idx <= 240
                 t = self._encoder_coll.put((encoder.name, idx)).data
-                self._encoder_prefix[encoder] = encode_int(idx)
-                self._prefix_encoder[encode_int(idx)] = encoder
+            self._encoder_prefix[encoder] = encode_int(t[1])
+            self._prefix_encoder[encode_int(t[1])] = encoder
             return encode_int(t[1])
 
     def get_encoder(self, prefix):
@@ -1319,3 +3431,16 @@ PLAIN_PACKER = Encoder('plain', str, lambda o: o)
 ZLIB_PACKER = Encoder('zlib', zlib.decompress, zlib.compress)
 
 _ENCODERS = (KEY_ENCODER, PICKLE_ENCODER, PLAIN_PACKER, ZLIB_PACKER)
+
+def _zlib_level(level):
+    return Encoder('zlib:%d' % (level,), zlib.decompress,
+                   lambda s: zlib.compress(s, level))
+
+# zlib at its fastest and smallest levels, as default AdaptivePacker
+# candidates. ZLIB_PACKER reads their output, so Store records its prefix.
+_ZLIB_LEVELS = (_zlib_level(1), _zlib_level(9))
+
+# Estimated seconds to unpack each output byte, for AdaptivePacker. zlib
+# decompresses at roughly 200MB/sec at any level.
+_UNPACK_COSTS = dict([('plain', 0.0), ('zlib', 5e-9)] +
+                     [('zlib:%d' % (level,), 5e-9) for level in xrange(10)])
@@ -369,3 +369,13 @@ def make_thrift_encoder(klass, factory=None):
     # Form a name from the Thrift ttypes module and struct name.
     name = 'thrift:%s.%s' % (klass.__module__, klass.__name__)
     return centidb.Encoder(name, loads, dumps)
+
+
+def make_zlib_packer(level):
+    """Return an :py:class:`Encoder <centidb.Encoder>` that compresses using
+    :py:func:`zlib.compress` at compression level `level`, for use alongside
+    ``ZLIB_PACKER`` as a candidate for :py:class:`centidb.AdaptivePacker`. The
+    encoder is named ``zlib:<level>``."""
+    import zlib
+    return centidb.Encoder('zlib:%d' % (level,), zlib.decompress,
+                           lambda s: zlib.compress(s, level))